@@ -7,25 +7,43 @@ from flask_login import LoginManager
 from flask_openid import OpenID
 from flask_mail import Mail
 from flask_babel import Babel, lazy_gettext
-from config import basedir, ADMINS, MAIL_PORT, MAIL_SERVER, \
+from config import ADMINS, MAIL_PORT, MAIL_SERVER, \
     MAIL_USERNAME, MAIL_PASSWORD
 from .momentjs import momentjs
+from .compress import GzipMiddleware
+from .pubsub import Broker
 
 app = Flask(__name__)
 app.config.from_object('config')
 app.jinja_env.globals['momentjs'] = momentjs
+app.wsgi_app = GzipMiddleware(app.wsgi_app,
+                              level=app.config['GZIP_LEVEL'],
+                              min_size=app.config['GZIP_MIN_SIZE'])
 db = SQLAlchemy(app)
 
 lm = LoginManager()
 lm.init_app(app)
 lm.login_view = 'login'
 lm.login_message = lazy_gettext('Please log in to access this page.')
-oid = OpenID(app, os.path.join(basedir, 'tmp'))
+oid = OpenID(app, store_factory=lambda: openid_store)
 
 mail = Mail(app)
 babel = Babel(app)
+broker = Broker()
 
-from app import views, models
+from .trending import TrendingTerms
+trending = TrendingTerms(app.config['TRENDING_TOP_K'],
+                         app.config['TRENDING_HALF_LIFE'],
+                         app.config['TRENDING_SNAPSHOT_INTERVAL'])
+
+from .openid_store import SQLAlchemyStore, DiscoveryCache
+openid_store = SQLAlchemyStore(app.config['OPENID_CLEANUP_INTERVAL'])
+openid_discovery = DiscoveryCache(app.config['OPENID_PROVIDERS'],
+                                  app.config['OPENID_DISCOVERY_TTL'],
+                                  app.config['OPENID_DISCOVERY_CACHE_SIZE'])
+openid_discovery.install()
+
+from app import views, models, api
 
 if not app.debug:
     import logging
@@ -0,0 +1,176 @@
+"""JSON API for the timeline, profiles and search.
+
+Lists use cursor pagination: every page carries a ``next_cursor`` which is
+passed back as ``?cursor=`` to get the next page. Responses can be trimmed
+with ``?fields=id,body`` and carry an ETag so clients can revalidate with
+If-None-Match instead of downloading the page again. The ETag leaves out
+fields that change on every request, like ``last_seen``, so they don't
+defeat revalidation; a 304 may carry a slightly old last_seen. Clients
+that aren't
+logged in get a JSON 401 rather than a redirect to the login page.
+"""
+
+import json
+import hashlib
+import itertools
+from functools import wraps
+from flask import request, g, Response
+import flask_login
+from config import POSTS_PER_PAGE, MAX_SEARCH_RESULTS, API_MAX_LIMIT
+from app import app, db
+from .models import User, Post, ArchivedPost
+from .archive import cursor_page, search_posts
+
+# Left out of ETags; before_request updates last_seen on every request
+UNHASHED_FIELDS = frozenset(['last_seen'])
+
+
+def _fields():
+    """Return the set of fields asked for with ?fields=, or None for all."""
+    fields = request.args.get('fields')
+    if not fields:
+        return None
+    return set(f.strip() for f in fields.split(',') if f.strip())
+
+
+def _select(item, fields):
+    """Drop the keys of a serialized item that weren't asked for."""
+    if fields is None:
+        return item
+    return dict((k, v) for k, v in item.items() if k in fields)
+
+
+def _stable(data):
+    """Return data without the fields left out of ETags."""
+    if isinstance(data, dict):
+        return dict((k, _stable(v)) for k, v in data.items()
+                    if k not in UNHASHED_FIELDS)
+    if isinstance(data, list):
+        return [_stable(v) for v in data]
+    return data
+
+
+def _json_response(data, status=200):
+    """Serialize data compactly and answer conditional requests."""
+    body = json.dumps(data, separators=(',', ':'), ensure_ascii=False)
+    resp = Response(body.encode('utf-8'), status=status,
+                    mimetype='application/json')
+    if status == 200:
+        stable = json.dumps(_stable(data), sort_keys=True,
+                            separators=(',', ':'))
+        resp.set_etag(hashlib.md5(stable.encode('utf-8')).hexdigest())
+        resp.make_conditional(request)
+    return resp
+
+
+def _error(status, message):
+    """Return a JSON error response."""
+    return _json_response({'error': message}, status)
+
+
+def _login_required(func):
+    """Answer with a JSON 401 unless the user is logged in."""
+    @wraps(func)
+    def decorated(*args, **kwargs):
+        if not flask_login.current_user.is_authenticated:
+            return _error(401, 'Login required')
+        return func(*args, **kwargs)
+    return decorated
+
+
+def _limit():
+    """Return the page size asked for with ?limit=, within bounds."""
+    limit = request.args.get('limit', POSTS_PER_PAGE, type=int)
+    return max(1, min(limit, API_MAX_LIMIT))
+
+
+def _cursor_page(query, column, archive=None, archive_column=None):
+    """Return one page of query, newest first, and the cursor for the next.
+
+    Pages are selected with ``column < cursor`` rather than an offset, so
+    walking deep into a list costs the same as reading the first page.
+    """
+    cursor = request.args.get('cursor', type=int)
+    return cursor_page(query, column, archive, archive_column, cursor,
+                       _limit())
+
+
+def _list_response(rows, next_cursor=None):
+    """Serialize a page of models."""
+    fields = _fields()
+    return _json_response({
+        'items': [_select(row.to_dict(), fields) for row in rows],
+        'next_cursor': next_cursor,
+    })
+
+
+@app.route('/api/v1/timeline')
+@_login_required
+def api_timeline():
+    """Return the posts of the users the current user follows."""
+    query = g.user.followed_posts().options(db.joinedload(Post.author))
+    archive = g.user.followed_archived_posts() \
+        .options(db.joinedload(ArchivedPost.author))
+    return _list_response(*_cursor_page(query, Post.id,
+                                        archive, ArchivedPost.id))
+
+
+@app.route('/api/v1/users/<nickname>')
+@_login_required
+def api_user(nickname):
+    """Return the profile of a user."""
+    user = User.query.filter_by(nickname=nickname).first()
+    if user is None:
+        return _error(404, 'User {0} not found'.format(nickname))
+    data = user.to_dict()
+    data['followers'] = user.followers.count()
+    data['following'] = user.followed.count()
+    data['posts'] = user.posts.count() + user.archived_posts.count()
+    return _json_response(_select(data, _fields()))
+
+
+@app.route('/api/v1/users/<nickname>/posts')
+@_login_required
+def api_user_posts(nickname):
+    """Return the posts written by a user."""
+    user = User.query.filter_by(nickname=nickname).first()
+    if user is None:
+        return _error(404, 'User {0} not found'.format(nickname))
+    query = user.posts.options(db.joinedload(Post.author))
+    archive = user.archived_posts \
+        .options(db.joinedload(ArchivedPost.author))
+    return _list_response(*_cursor_page(query, Post.id,
+                                        archive, ArchivedPost.id))
+
+
+@app.route('/api/v1/users/<nickname>/followers')
+@_login_required
+def api_user_followers(nickname):
+    """Return the users following a user."""
+    user = User.query.filter_by(nickname=nickname).first()
+    if user is None:
+        return _error(404, 'User {0} not found'.format(nickname))
+    return _list_response(*_cursor_page(user.followers, User.id))
+
+
+@app.route('/api/v1/search')
+@_login_required
+def api_search():
+    """Return the posts matching ?q=, best match first.
+
+    Results are ranked rather than sorted by id, so here the cursor is the
+    position of the next result. Search goes no deeper than
+    MAX_SEARCH_RESULTS.
+    """
+    query = request.args.get('q', '')
+    if not query:
+        return _error(400, 'Missing search query')
+    limit = _limit()
+    start = max(0, request.args.get('cursor', 0, type=int))
+    end = min(start + limit + 1, MAX_SEARCH_RESULTS)
+    rows = list(itertools.islice(search_posts(query, end), start, end))
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = start + limit
+    return _list_response(rows, next_cursor)
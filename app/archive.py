@@ -0,0 +1,187 @@
+"""Archiving of old posts, and reads that fall through to the archive.
+
+Old posts are moved from the post table into post_archive so that timeline,
+profile and search queries only touch the recent posts nearly every read
+asks for. The helpers below read the hot table first and only query the
+archive once a page or cursor walks past the end of it.
+"""
+
+import datetime
+from app import db
+from .models import Post, ArchivedPost
+
+
+def archive_posts(max_age, batch_size=500, now=None):
+    """Move posts older than max_age into the archive.
+
+    Posts are moved through the ORM in batches, one commit per batch, so the
+    search index of both tables is kept up to date and no single transaction
+    holds the database for long. Returns the number of posts moved.
+    """
+    if now is None:
+        now = datetime.datetime.utcnow()
+    cutoff = now - max_age
+    moved = 0
+    while True:
+        posts = Post.query.filter(Post.timestamp < cutoff) \
+            .order_by(Post.id).limit(batch_size).all()
+        if not posts:
+            break
+        for post in posts:
+            db.session.add(ArchivedPost(id=post.id,
+                                        body=post.body,
+                                        timestamp=post.timestamp,
+                                        user_id=post.user_id))
+            db.session.delete(post)
+        db.session.commit()
+        moved += len(posts)
+    return moved
+
+
+def reserve_archived_ids(conn):
+    """Make new posts get ids above every hot and archived post.
+
+    SQLite hands out ids above the highest one the post table has ever
+    held, which misses ids that only ever went into post_archive, e.g. from
+    an import.
+    """
+    if conn.dialect.name != 'sqlite':
+        return
+    top = conn.execute('SELECT MAX(id) FROM (SELECT id FROM post UNION '
+                       'SELECT id FROM post_archive)').scalar() or 0
+    current = conn.execute("SELECT seq FROM sqlite_sequence "
+                           "WHERE name = 'post'").scalar()
+    if current is None:
+        conn.execute("INSERT INTO sqlite_sequence (name, seq) "
+                     "VALUES ('post', ?)", (top,))
+    elif current < top:
+        conn.execute("UPDATE sqlite_sequence SET seq = ? "
+                     "WHERE name = 'post'", (top,))
+
+
+class ArchivePagination(object):
+    """Page through hot posts, then archived posts, as one list.
+
+    Mirrors the parts of flask_sqlalchemy's Pagination the templates use.
+    Counting and loading the archive only happens for pages that reach past
+    the hot posts.
+    """
+
+    def __init__(self, hot, cold, page, per_page,
+                 hot_total=None, cold_total=None):
+        """Initialize the pagination, counting the hot query if needed."""
+        self.hot = hot
+        self.cold = cold
+        self.page = page
+        self.per_page = per_page
+        if hot_total is None:
+            hot_total = hot.order_by(None).count()
+        self.hot_total = hot_total
+        self._cold_total = cold_total
+        self._items = None
+
+    @property
+    def cold_total(self):
+        """Number of archived posts, counted on first use."""
+        if self._cold_total is None:
+            self._cold_total = self.cold.order_by(None).count()
+        return self._cold_total
+
+    @property
+    def total(self):
+        """Total number of posts, hot and archived."""
+        return self.hot_total + self.cold_total
+
+    @property
+    def items(self):
+        """Posts on this page."""
+        if self._items is None:
+            offset = (self.page - 1) * self.per_page
+            items = []
+            if offset < self.hot_total:
+                items = self.hot.limit(self.per_page).offset(offset).all()
+            if len(items) < self.per_page:
+                cold_offset = max(0, offset - self.hot_total)
+                items += self.cold.limit(self.per_page - len(items)) \
+                    .offset(cold_offset).all()
+            self._items = items
+        return self._items
+
+    def _has_page(self, page):
+        """Check if a page number has any posts on it."""
+        if page < 1:
+            return False
+        offset = (page - 1) * self.per_page
+        return offset < self.hot_total or \
+            offset - self.hot_total < self.cold_total
+
+    def _sibling(self, page):
+        """Return the pagination for another page, sharing the counts."""
+        return ArchivePagination(self.hot, self.cold, page, self.per_page,
+                                 self.hot_total, self._cold_total)
+
+    @property
+    def has_prev(self):
+        """True if a previous page exists."""
+        return self.page > 1
+
+    @property
+    def prev_num(self):
+        """Number of the previous page."""
+        return self.page - 1
+
+    def prev(self):
+        """Return the pagination for the previous page."""
+        return self._sibling(self.page - 1)
+
+    @property
+    def has_next(self):
+        """True if a next page exists."""
+        return self._has_page(self.page + 1)
+
+    @property
+    def next_num(self):
+        """Number of the next page."""
+        return self.page + 1
+
+    def next(self):
+        """Return the pagination for the next page."""
+        return self._sibling(self.page + 1)
+
+
+def cursor_page(hot, hot_column, cold, cold_column, cursor, limit):
+    """Return up to limit rows below cursor, newest first, and next cursor.
+
+    Rows come from the hot query first. Only if it runs out is the cold
+    query asked for the rest of the page. Pass cold=None for lists that
+    have no archive.
+    """
+    hot = hot.order_by(None).order_by(hot_column.desc())
+    if cursor is not None:
+        hot = hot.filter(hot_column < cursor)
+    rows = hot.limit(limit + 1).all()
+    if len(rows) <= limit and cold is not None:
+        cold = cold.order_by(None).order_by(cold_column.desc())
+        if cursor is not None:
+            cold = cold.filter(cold_column < cursor)
+        rows += cold.limit(limit + 1 - len(rows)).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1].id
+    return rows, next_cursor
+
+
+def search_posts(query, limit):
+    """Yield posts matching a search, falling back to the archive.
+
+    Results are generated lazily, so a streamed page can start sending
+    before the search runs.
+    """
+    found = 0
+    for post in Post.query.whoosh_search(query, limit):
+        found += 1
+        yield post
+    if found < limit:
+        for post in ArchivedPost.query.whoosh_search(query, limit - found):
+            yield post
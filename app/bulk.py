@@ -0,0 +1,151 @@
+"""Bulk export and import of users, follows and posts.
+
+Rows are streamed out of the database in batches and written as NDJSON or
+CSV, so memory use doesn't grow with table size. CSV can't tell an empty
+string from NULL and reads both back as NULL; NDJSON keeps them apart.
+Imports insert batches with a single executemany per chunk and skip the
+per-row search indexing done by the ORM; the search index is rebuilt once
+at the end instead.
+"""
+
+import csv
+import json
+import datetime
+import dateutil.parser
+import flask_whooshalchemyplus
+from app import app, db
+from .models import Post, ArchivedPost
+from .archive import reserve_archived_ids
+
+# In foreign key order, so an import can load them in this order
+TABLES = ('user', 'followers', 'post', 'post_archive', 'tag', 'post_tag',
+          'mention')
+FORMATS = ('ndjson', 'csv')
+
+
+def _columns(table_name):
+    """Return the columns of a table."""
+    return db.metadata.tables[table_name].columns
+
+
+def export_rows(table_name, batch_size=1000):
+    """Yield every row of a table as a dict, batch_size rows at a time."""
+    table = db.metadata.tables[table_name]
+    order = list(table.primary_key) or list(table.columns)
+    query = table.select().order_by(*order)
+    conn = db.engine.connect().execution_options(stream_results=True)
+    try:
+        result = conn.execute(query)
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield dict(row)
+    finally:
+        conn.close()
+
+
+def _dump_value(value):
+    """Convert a column value into something JSON/CSV can hold."""
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+def _load_value(column, value, fmt):
+    """Convert a value read back from a file into the column's type.
+
+    CSV writes NULL as an empty field, so an empty string read from CSV is
+    NULL; NDJSON keeps the two apart.
+    """
+    if value is None or (value == '' and fmt == 'csv'):
+        return None
+    if isinstance(column.type, db.DateTime):
+        return dateutil.parser.parse(value)
+    if isinstance(column.type, db.Integer):
+        return int(value)
+    return value
+
+
+def write_rows(table_name, rows, f, fmt='ndjson'):
+    """Write rows to a file object, returning how many were written."""
+    names = [c.name for c in _columns(table_name)]
+    if fmt == 'csv':
+        writer = csv.writer(f)
+        writer.writerow(names)
+    count = 0
+    for row in rows:
+        values = [_dump_value(row[name]) for name in names]
+        if fmt == 'csv':
+            writer.writerow(values)
+        else:
+            f.write(json.dumps(dict(zip(names, values)),
+                               separators=(',', ':')))
+            f.write('\n')
+        count += 1
+    return count
+
+
+def read_rows(table_name, f, fmt='ndjson'):
+    """Yield rows from a file object, typed for the table's columns."""
+    columns = _columns(table_name)
+    if fmt == 'csv':
+        records = csv.DictReader(f)
+    else:
+        records = (json.loads(line) for line in f if line.strip())
+    for record in records:
+        yield dict((c.name, _load_value(c, record.get(c.name), fmt))
+                   for c in columns)
+
+
+def import_rows(table_name, rows, batch_size=1000):
+    """Insert rows into a table in chunks, returning how many were inserted.
+
+    Each chunk is committed on its own, so an import doesn't hold one
+    transaction (and lock) for the whole table. Importing posts makes sure
+    new posts won't reuse the id of an imported one, archived or not.
+    """
+    table = db.metadata.tables[table_name]
+    count = 0
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= batch_size:
+            count += _insert_chunk(table, chunk)
+            chunk = []
+    if chunk:
+        count += _insert_chunk(table, chunk)
+    if table_name in ('post', 'post_archive'):
+        with db.engine.begin() as conn:
+            reserve_archived_ids(conn)
+    return count
+
+
+def _insert_chunk(table, chunk):
+    """Insert a chunk of rows with one executemany."""
+    with db.engine.begin() as conn:
+        conn.execute(table.insert(), chunk)
+    return len(chunk)
+
+
+def reindex(model, batch_size=1000):
+    """Rebuild the search index for every row of a model in one writer."""
+    index = flask_whooshalchemyplus.whoosh_index(app, model)
+    if index is None:
+        return 0
+    primary = model.pure_whoosh.primary_key_name
+    count = 0
+    with index.writer() as writer:
+        for row in model.query.order_by(model.id).yield_per(batch_size):
+            attrs = dict((key, str(getattr(row, key)))
+                         for key in model.__searchable__)
+            attrs[primary] = str(getattr(row, primary))
+            writer.update_document(**attrs)
+            count += 1
+    return count
+
+
+def reindex_posts(batch_size=1000):
+    """Rebuild the search index for posts and archived posts."""
+    return sum(reindex(model, batch_size) for model in (Post, ArchivedPost))
@@ -0,0 +1,98 @@
+"""WSGI middleware for gzip compressing responses."""
+
+import zlib
+from werkzeug.datastructures import Headers
+
+
+class GzipMiddleware(object):
+    """Gzip compress responses for clients that accept it.
+
+    Responses with a known Content-Length are compressed in one go. Streamed
+    responses (no Content-Length) are compressed chunk by chunk, flushing the
+    compressor after every chunk so the client can render what it has so far.
+    """
+
+    def __init__(self, app, level=6, min_size=500,
+                 mimetypes=('text/html', 'text/plain', 'text/css',
+                            'application/json', 'application/javascript')):
+        """Wrap the WSGI application."""
+        self.app = app
+        self.level = level
+        self.min_size = min_size
+        self.mimetypes = mimetypes
+
+    def __call__(self, environ, start_response):
+        """Handle a request, compressing the response if possible."""
+        if 'gzip' not in environ.get('HTTP_ACCEPT_ENCODING', '') or \
+                environ.get('REQUEST_METHOD') == 'HEAD':
+            return self.app(environ, start_response)
+
+        state = {}
+
+        def capture_start_response(status, headers, exc_info=None):
+            """Hold on to the response headers until we know the body."""
+            state['status'] = status
+            state['headers'] = headers
+            state['exc_info'] = exc_info
+
+        app_iter = self.app(environ, capture_start_response)
+        headers = Headers(state['headers'])
+        if not self.should_compress(state['status'], headers):
+            start_response(state['status'], state['headers'],
+                           state['exc_info'])
+            return app_iter
+
+        headers['Content-Encoding'] = 'gzip'
+        headers.add('Vary', 'Accept-Encoding')
+        if 'Content-Length' in headers:
+            try:
+                body = b''.join(app_iter)
+            finally:
+                if hasattr(app_iter, 'close'):
+                    app_iter.close()
+            body = self.compress(body)
+            headers['Content-Length'] = str(len(body))
+            start_response(state['status'], headers.to_wsgi_list(),
+                           state['exc_info'])
+            return [body]
+        start_response(state['status'], headers.to_wsgi_list(),
+                       state['exc_info'])
+        return self.compress_stream(app_iter)
+
+    def should_compress(self, status, headers):
+        """Check if a response with these headers is worth compressing."""
+        if int(status.split(' ', 1)[0]) in (204, 304):
+            return False
+        if 'Content-Encoding' in headers:
+            return False
+        mimetype = headers.get('Content-Type', '').split(';')[0].strip()
+        if mimetype not in self.mimetypes:
+            return False
+        length = headers.get('Content-Length')
+        if length is not None and int(length) < self.min_size:
+            return False
+        return True
+
+    def _compressor(self):
+        """Return a compressor that writes gzip framing."""
+        return zlib.compressobj(self.level, zlib.DEFLATED,
+                                16 + zlib.MAX_WBITS)
+
+    def compress(self, body):
+        """Compress a whole response body."""
+        compressor = self._compressor()
+        return compressor.compress(body) + compressor.flush()
+
+    def compress_stream(self, app_iter):
+        """Compress a streamed response body, flushing after every chunk."""
+        compressor = self._compressor()
+        try:
+            for chunk in app_iter:
+                if not chunk:
+                    continue
+                yield compressor.compress(chunk) + \
+                    compressor.flush(zlib.Z_SYNC_FLUSH)
+            yield compressor.flush()
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
@@ -13,6 +13,53 @@ followers = db.Table('followers',
                      db.Column('followed_id', db.Integer,
                                db.ForeignKey('user.id')))
 
+# Inverted indexes of the hashtags and mentions in post bodies. Rows are
+# keyed by post id only, so they keep working once a post is archived.
+post_tags = db.Table('post_tag',
+                     db.Column('post_id', db.Integer, index=True),
+                     db.Column('tag_id', db.Integer,
+                               db.ForeignKey('tag.id')),
+                     db.Index('ix_post_tag_tag_id_post_id',
+                              'tag_id', 'post_id'))
+
+mentions = db.Table('mention',
+                    db.Column('post_id', db.Integer, index=True),
+                    db.Column('user_id', db.Integer,
+                              db.ForeignKey('user.id')),
+                    db.Index('ix_mention_user_id_post_id',
+                             'user_id', 'post_id'))
+
+# Who to follow, written by the offline job in app/recommend.py
+recommendations = db.Table('recommendation',
+                           db.Column('user_id', db.Integer,
+                                     db.ForeignKey('user.id'), index=True),
+                           db.Column('recommended_id', db.Integer,
+                                     db.ForeignKey('user.id')),
+                           db.Column('score', db.Integer))
+
+# Last snapshot of the trending terms tracked in app/trending.py
+trending_terms = db.Table('trending_term',
+                          db.Column('term', db.String(65), primary_key=True),
+                          db.Column('score', db.Float),
+                          db.Column('taken', db.DateTime))
+
+# OpenID associations and used nonces, kept by app/openid_store.py
+oid_associations = db.Table('oid_association',
+                            db.Column('server_url', db.String(2047),
+                                      primary_key=True),
+                            db.Column('handle', db.String(255),
+                                      primary_key=True),
+                            db.Column('secret', db.LargeBinary(128)),
+                            db.Column('issued', db.Integer),
+                            db.Column('lifetime', db.Integer),
+                            db.Column('assoc_type', db.String(64)))
+
+oid_nonces = db.Table('oid_nonce',
+                      db.Column('server_url', db.String(2047)),
+                      db.Column('timestamp', db.Integer, index=True),
+                      db.Column('salt', db.String(40)),
+                      db.UniqueConstraint('server_url', 'timestamp', 'salt'))
+
 
 class User(db.Model):
     """User object."""
@@ -21,6 +68,8 @@ class User(db.Model):
     nickname = db.Column(db.String(64), index=True, unique=True)
     email = db.Column(db.String(120), index=True, unique=True)
     posts = db.relationship('Post', backref='author', lazy='dynamic')
+    archived_posts = db.relationship('ArchivedPost', backref='author',
+                                     lazy='dynamic')
     about_me = db.Column(db.String(140), unique=False)
     last_seen = db.Column(db.DateTime)
     followed = db.relationship('User',
@@ -54,6 +103,32 @@ class User(db.Model):
             .filter(followers.c.follower_id == self.id) \
             .order_by(Post.timestamp.desc())
 
+    def followed_archived_posts(self):
+        """Return archived posts of followed users, sorted by date."""
+        return ArchivedPost.query.join(
+            followers, (followers.c.followed_id == ArchivedPost.user_id)) \
+            .filter(followers.c.follower_id == self.id) \
+            .order_by(ArchivedPost.timestamp.desc())
+
+    def recommended_users(self, limit):
+        """Return recommended users not followed yet, best first.
+
+        Ties go to the lower id, matching the order the job ranks them in.
+        """
+        followed_ids = db.select([followers.c.followed_id]) \
+            .where(followers.c.follower_id == self.id)
+        return User.query.join(recommendations,
+                               recommendations.c.recommended_id == User.id) \
+            .filter(recommendations.c.user_id == self.id) \
+            .filter(~User.id.in_(followed_ids)) \
+            .order_by(recommendations.c.score.desc(),
+                      recommendations.c.recommended_id).limit(limit)
+
+    def followed_posts_since(self, since_id):
+        """Return posts of followed users newer than since_id, oldest first."""
+        return self.followed_posts().filter(Post.id > since_id) \
+            .order_by(None).order_by(Post.id)
+
     @staticmethod
     def make_valid_nickname(nickname):
         """Convert a user-generated nickname into a valid one.
@@ -89,6 +164,17 @@ class User(db.Model):
             md5=hashlib.md5(self.email.encode('utf-8')).hexdigest()
         )
 
+    def to_dict(self):
+        """Return the user as a JSON serializable dict."""
+        return {
+            'id': self.id,
+            'nickname': self.nickname,
+            'about_me': self.about_me,
+            'last_seen': self.last_seen.isoformat()
+            if self.last_seen else None,
+            'avatar': self.avatar(128),
+        }
+
     @property
     def is_authenticated(self):
         """User is authenticated."""
@@ -119,17 +205,61 @@ class User(db.Model):
 class Post(db.Model):
     """User post object."""
 
+    # Archived posts keep their ids, so an id must never be handed out twice
+    __table_args__ = {'sqlite_autoincrement': True}
     __searchable__ = ['body']
 
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.String(200))
-    timestamp = db.Column(db.DateTime)
+    timestamp = db.Column(db.DateTime, index=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
 
+    def to_dict(self):
+        """Return the post as a JSON serializable dict."""
+        return {
+            'id': self.id,
+            'body': self.body,
+            'timestamp': self.timestamp.isoformat(),
+            'author': self.author.nickname,
+        }
+
     def __repr__(self):
         """Representation of post."""
         return '<Post {0!r}>'.format(self.body)
 
 
+class ArchivedPost(db.Model):
+    """Post moved out of the post table by the archiver.
+
+    Archived posts keep the id they had as a Post, so id cursors carry on
+    from the post table into the archive.
+    """
+
+    __tablename__ = 'post_archive'
+    __searchable__ = ['body']
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    body = db.Column(db.String(200))
+    timestamp = db.Column(db.DateTime)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+
+    to_dict = Post.to_dict
+
+    def __repr__(self):
+        """Representation of archived post."""
+        return '<ArchivedPost {0!r}>'.format(self.body)
+
+
+class Tag(db.Model):
+    """Hashtag used in posts."""
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(64), index=True, unique=True)
+
+    def __repr__(self):
+        """Representation of tag."""
+        return '<Tag {0!r}>'.format(self.name)
+
+
 # Initialize search
 flask_whooshalchemyplus.init_app(app)
@@ -0,0 +1,287 @@
+"""Online schema migrations with batched, resumable backfills.
+
+A migration runs in three phases:
+
+expand
+    Additive schema changes (new tables, columns, indexes) that the running
+    code can live with. Runs in one transaction, which is short for new
+    tables and columns. SQLite can't build an index online: CREATE INDEX
+    holds the write lock until the whole index is built, so writers wait
+    for it. Schedule migrations that add indexes to big tables for a quiet
+    time.
+backfill
+    Fills in data in batches, one small transaction per batch, so other
+    connections get the database between batches. The last key processed
+    is saved in the same transaction as the batch, so an interrupted
+    backfill picks up where it stopped.
+contract
+    Removes whatever the old code needed once the backfill is done.
+
+Progress is kept in the online_migration table.
+"""
+
+import time
+import datetime
+from collections import OrderedDict
+from sqlalchemy import inspect
+from app import db
+from .archive import reserve_archived_ids
+
+checkpoints = db.Table('online_migration',
+                       db.Column('name', db.String(64), primary_key=True),
+                       db.Column('phase', db.String(16)),
+                       db.Column('last_key', db.Integer),
+                       db.Column('rows_done', db.Integer),
+                       db.Column('updated', db.DateTime))
+
+MIGRATIONS = OrderedDict()
+
+
+def register(cls):
+    """Make a migration available to the runner by name."""
+    MIGRATIONS[cls.name] = cls
+    return cls
+
+
+class OnlineMigration(object):
+    """Base class for online migrations.
+
+    Subclasses set ``name`` and override the phases they need.
+    """
+
+    name = None
+
+    def expand(self, conn):
+        """Apply additive schema changes."""
+
+    def total(self, conn):
+        """Return the number of rows the backfill will touch, if known."""
+
+    def backfill(self, conn, after, batch_size):
+        """Process one batch of rows with keys after ``after``.
+
+        ``after`` is None for the first batch. Return a tuple of the last key
+        processed and the number of rows processed; zero rows means the
+        backfill is finished.
+        """
+        return after, 0
+
+    def contract(self, conn):
+        """Remove schema the old code needed."""
+
+
+class Progress(object):
+    """Snapshot of a running backfill, passed to progress reporters."""
+
+    def __init__(self, name, rows_done, total, elapsed, rows_this_run):
+        """Initialize the snapshot."""
+        self.name = name
+        self.rows_done = rows_done
+        self.total = total
+        self.elapsed = elapsed
+        self.rows_this_run = rows_this_run
+
+    @property
+    def rate(self):
+        """Rows per second processed by this run."""
+        if self.elapsed <= 0:
+            return 0.0
+        return self.rows_this_run / self.elapsed
+
+    def __str__(self):
+        """Format the progress for printing."""
+        done = str(self.rows_done)
+        if self.total:
+            done = '{0}/{1} ({2:.1f}%)'.format(
+                self.rows_done, self.total,
+                100.0 * self.rows_done / self.total)
+        return '{0}: {1} rows, {2:.0f} rows/s'.format(
+            self.name, done, self.rate)
+
+
+def print_progress(progress):
+    """Print progress to stdout."""
+    print(progress)
+
+
+def _load_checkpoint(name):
+    """Return the saved state of a migration, or None if it never ran."""
+    with db.engine.connect() as conn:
+        row = conn.execute(checkpoints.select()
+                           .where(checkpoints.c.name == name)).first()
+    return dict(row) if row is not None else None
+
+
+def _save_checkpoint(conn, state):
+    """Save the state of a migration inside the caller's transaction."""
+    state['updated'] = datetime.datetime.utcnow()
+    conn.execute(checkpoints.update()
+                 .where(checkpoints.c.name == state['name'])
+                 .values(**state))
+
+
+def has_index(conn, table, name):
+    """Check if a table already has an index."""
+    return name in [i['name'] for i in inspect(conn).get_indexes(table)]
+
+
+def has_column_index(conn, table, column):
+    """Check if a table has an index on just one column, by any name."""
+    return [column] in [i['column_names']
+                        for i in inspect(conn).get_indexes(table)]
+
+
+def run_migration(migration, batch_size=1000, report=print_progress,
+                  contract=True, sleep=0):
+    """Run or resume a migration, returning its final phase.
+
+    Pass contract=False to stop after the backfill, e.g. until every server
+    runs code that no longer needs the old schema. ``sleep`` seconds are
+    waited between batches to leave room for other writers.
+    """
+    checkpoints.create(db.engine, checkfirst=True)
+    state = _load_checkpoint(migration.name)
+    if state is None:
+        state = {'name': migration.name, 'phase': 'backfill',
+                 'last_key': None, 'rows_done': 0,
+                 'updated': datetime.datetime.utcnow()}
+        with db.engine.begin() as conn:
+            migration.expand(conn)
+            conn.execute(checkpoints.insert(), state)
+
+    if state['phase'] == 'backfill':
+        with db.engine.connect() as conn:
+            total = migration.total(conn)
+        start = time.time()
+        rows_this_run = 0
+        while True:
+            with db.engine.begin() as conn:
+                last_key, rows = migration.backfill(conn, state['last_key'],
+                                                    batch_size)
+                if rows:
+                    state['last_key'] = last_key
+                    state['rows_done'] += rows
+                else:
+                    state['phase'] = 'contract'
+                _save_checkpoint(conn, state)
+            if not rows:
+                break
+            rows_this_run += rows
+            if report is not None:
+                report(Progress(migration.name, state['rows_done'], total,
+                                time.time() - start, rows_this_run))
+            if sleep:
+                time.sleep(sleep)
+
+    if state['phase'] == 'contract' and contract:
+        with db.engine.begin() as conn:
+            migration.contract(conn)
+            state['phase'] = 'done'
+            _save_checkpoint(conn, state)
+    return state['phase']
+
+
+@register
+class PostTimestampIndex(OnlineMigration):
+    """Index post.timestamp for timeline ordering and archiving.
+
+    Building the index blocks writes to the database until it is done,
+    on the order of a second per million posts.
+    """
+
+    name = 'post_timestamp_index'
+
+    def expand(self, conn):
+        """Create the index unless the table was created with it."""
+        if not has_column_index(conn, 'post', 'timestamp'):
+            conn.execute('CREATE INDEX ix_post_timestamp ON post (timestamp)')
+
+
+@register
+class PostAutoincrement(OnlineMigration):
+    """Rebuild the post table with AUTOINCREMENT so ids are never reused.
+
+    Without it SQLite hands out the highest id in the table plus one, which
+    is the id of an archived post once the newest posts are archived. SQLite
+    can't change a primary key in place, so posts are copied into a new
+    table in batches and the tables are swapped in the contract phase.
+
+    Triggers on post keep the new table up to date with writes made during
+    the copy, and its timestamp index is built as rows are copied, so the
+    contract only drops the old table and renames the new one. It still
+    blocks writes while SQLite frees the old table's pages, a fraction of
+    a second per million posts. SQLite can't rename an index, so the
+    rebuilt table's timestamp index is named ix_post_new_timestamp.
+    """
+
+    name = 'post_autoincrement'
+
+    def _has_autoincrement(self, conn):
+        """Check if the post table already uses AUTOINCREMENT."""
+        if conn.dialect.name != 'sqlite':
+            return True
+        sql = conn.execute("SELECT sql FROM sqlite_master "
+                           "WHERE type = 'table' AND name = 'post'").scalar()
+        return 'AUTOINCREMENT' in sql.upper()
+
+    def _rebuilding(self, conn):
+        """Check if the new table exists."""
+        return 'post_new' in inspect(conn).get_table_names()
+
+    def expand(self, conn):
+        """Create the new table and the triggers that keep it current."""
+        if self._has_autoincrement(conn):
+            return
+        conn.execute('CREATE TABLE post_new ('
+                     'id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, '
+                     'body VARCHAR(200), '
+                     'timestamp DATETIME, '
+                     'user_id INTEGER REFERENCES user (id))')
+        conn.execute('CREATE INDEX ix_post_new_timestamp '
+                     'ON post_new (timestamp)')
+        conn.execute('CREATE TRIGGER post_new_insert AFTER INSERT ON post '
+                     'BEGIN INSERT OR REPLACE INTO post_new VALUES '
+                     '(new.id, new.body, new.timestamp, new.user_id); END')
+        conn.execute('CREATE TRIGGER post_new_update AFTER UPDATE ON post '
+                     'BEGIN DELETE FROM post_new WHERE id = old.id; '
+                     'INSERT OR REPLACE INTO post_new VALUES '
+                     '(new.id, new.body, new.timestamp, new.user_id); END')
+        conn.execute('CREATE TRIGGER post_new_delete AFTER DELETE ON post '
+                     'BEGIN DELETE FROM post_new WHERE id = old.id; END')
+
+    def total(self, conn):
+        """Return the number of posts to copy."""
+        if not self._rebuilding(conn):
+            return 0
+        return conn.execute('SELECT COUNT(*) FROM post').scalar()
+
+    def backfill(self, conn, after, batch_size):
+        """Copy a batch of posts into the new table.
+
+        Posts the triggers already copied are skipped, but still counted.
+        """
+        if not self._rebuilding(conn):
+            return after, 0
+        after = after or 0
+        rows, last = conn.execute('SELECT COUNT(*), MAX(id) FROM '
+                                  '(SELECT id FROM post WHERE id > ? '
+                                  'ORDER BY id LIMIT ?)',
+                                  (after, batch_size)).first()
+        if not rows:
+            return after, 0
+        conn.execute('INSERT OR IGNORE INTO post_new '
+                     'SELECT id, body, timestamp, user_id FROM post '
+                     'WHERE id > ? AND id <= ?', (after, last))
+        return last, rows
+
+    def contract(self, conn):
+        """Swap the tables, dropping the old one and its triggers.
+
+        The sequence starts above every id in the archive as well, since
+        archived posts may already have had their ids reused.
+        """
+        if not self._rebuilding(conn):
+            return
+        conn.execute('DROP TABLE post')
+        conn.execute('ALTER TABLE post_new RENAME TO post')
+        reserve_archived_ids(conn)
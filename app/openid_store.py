@@ -0,0 +1,183 @@
+"""OpenID state kept in the database, and cached provider discovery.
+
+The consumer needs somewhere to keep the associations it negotiates with
+providers and the nonces it has already accepted. Keeping them in the
+database instead of files under tmp/ lets every worker and host share them,
+and expired rows are deleted every so often as nonces come in.
+
+Discovery of a provider's endpoint fetches and parses its XRDS document on
+every login. The result for a given provider URL rarely changes, so
+discovery of the URLs in OPENID_PROVIDERS is cached for a while.
+"""
+
+import re
+import copy
+import time
+import threading
+from collections import OrderedDict
+from sqlalchemy import and_, select
+from sqlalchemy.exc import IntegrityError
+from openid.association import Association
+from openid.consumer import consumer
+from openid.consumer.discover import discover as openid_discover
+from openid.store import nonce
+from openid.store.interface import OpenIDStore
+from app import db
+from .models import oid_associations, oid_nonces
+
+
+class SQLAlchemyStore(OpenIDStore):
+    """OpenID store backed by the oid_association and oid_nonce tables."""
+
+    def __init__(self, cleanup_interval=3600):
+        """Initialize the store."""
+        self.cleanup_interval = cleanup_interval
+        self._last_cleanup = time.time()
+
+    def storeAssociation(self, server_url, association):
+        """Save an association, replacing one with the same handle."""
+        key = and_(oid_associations.c.server_url == server_url,
+                   oid_associations.c.handle == association.handle)
+        with db.engine.begin() as conn:
+            conn.execute(oid_associations.delete().where(key))
+            conn.execute(oid_associations.insert(), {
+                'server_url': server_url,
+                'handle': association.handle,
+                'secret': association.secret,
+                'issued': association.issued,
+                'lifetime': association.lifetime,
+                'assoc_type': association.assoc_type})
+
+    def getAssociation(self, server_url, handle=None):
+        """Return an unexpired association, the newest if no handle given."""
+        expires = oid_associations.c.issued + oid_associations.c.lifetime
+        query = select([oid_associations]) \
+            .where(oid_associations.c.server_url == server_url) \
+            .where(expires > int(time.time())) \
+            .order_by(oid_associations.c.issued.desc())
+        if handle is not None:
+            query = query.where(oid_associations.c.handle == handle)
+        with db.engine.connect() as conn:
+            row = conn.execute(query.limit(1)).first()
+        if row is None:
+            return None
+        return Association(row.handle, bytes(row.secret), row.issued,
+                           row.lifetime, row.assoc_type)
+
+    def removeAssociation(self, server_url, handle):
+        """Delete an association, returning whether there was one."""
+        with db.engine.begin() as conn:
+            result = conn.execute(oid_associations.delete().where(
+                and_(oid_associations.c.server_url == server_url,
+                     oid_associations.c.handle == handle)))
+        return result.rowcount > 0
+
+    def useNonce(self, server_url, timestamp, salt):
+        """Return whether a nonce is fresh, recording it as used."""
+        now = time.time()
+        if abs(timestamp - now) > nonce.SKEW:
+            return False
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(oid_nonces.insert(), {
+                    'server_url': server_url,
+                    'timestamp': timestamp,
+                    'salt': salt})
+        except IntegrityError:
+            return False
+        self.maybe_cleanup(now)
+        return True
+
+    def cleanupNonces(self):
+        """Delete nonces too old to be accepted, returning how many."""
+        cutoff = int(time.time()) - nonce.SKEW
+        with db.engine.begin() as conn:
+            return conn.execute(oid_nonces.delete().where(
+                oid_nonces.c.timestamp < cutoff)).rowcount
+
+    def cleanupAssociations(self):
+        """Delete expired associations, returning how many."""
+        expires = oid_associations.c.issued + oid_associations.c.lifetime
+        with db.engine.begin() as conn:
+            return conn.execute(oid_associations.delete().where(
+                expires < int(time.time()))).rowcount
+
+    def maybe_cleanup(self, now=None):
+        """Clean up if the last cleanup is older than cleanup_interval."""
+        if now is None:
+            now = time.time()
+        if now - self._last_cleanup >= self.cleanup_interval:
+            self._last_cleanup = now
+            self.cleanup()
+            return True
+        return False
+
+
+class DiscoveryCache(object):
+    """Cache of OpenID discovery results for known provider URLs.
+
+    Only URLs matching a provider URL are cached, with any <username> in it
+    matching a single path segment. Failed discoveries are not cached. Since
+    anyone can submit a URL with a new username, at most max_size results
+    are kept, dropping the least recently used.
+    """
+
+    def __init__(self, providers, ttl=3600, max_size=1000,
+                 discover=openid_discover):
+        """Initialize the cache for a list of provider dicts."""
+        self.ttl = ttl
+        self.max_size = max_size
+        self._discover = discover
+        self._patterns = [
+            re.compile(re.escape(p['url']).replace(
+                re.escape('<username>'), '[^/?#]+') + '/?$')
+            for p in providers]
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    def cacheable(self, url):
+        """Return whether url is one of the provider URLs."""
+        return any(p.match(url) for p in self._patterns)
+
+    def discover(self, url):
+        """Discover url, returning (claimed id, services) like discover."""
+        if not self.cacheable(url):
+            return self._discover(url)
+        now = time.time()
+        with self._lock:
+            # Put back at the end as the most recently used, unless expired
+            cached = self._results.pop(url, None)
+            if cached is not None and cached[0] > now:
+                self._results[url] = cached
+        if cached is None or cached[0] <= now:
+            result = self._discover(url)
+            if not result[1]:
+                return result
+            cached = (now + self.ttl, result)
+            with self._lock:
+                self._results[url] = cached
+                while len(self._results) > self.max_size:
+                    self._results.popitem(last=False)
+        # The consumer pops services off the list it's given
+        claimed_id, services = cached[1]
+        return claimed_id, copy.deepcopy(services)
+
+    def __len__(self):
+        """Return the number of cached results."""
+        return len(self._results)
+
+    def clear(self):
+        """Forget every cached result."""
+        with self._lock:
+            self._results.clear()
+
+    def install(self):
+        """Make the OpenID consumer discover through this cache.
+
+        Flask-OpenID builds a new Consumer for every login and has no hook
+        for how it discovers, so the function is replaced on the classes,
+        for the whole process. python-openid keeps it in _discover for
+        this kind of override.
+        """
+        consumer.Consumer._discover = staticmethod(self.discover)
+        consumer.GenericConsumer._discover = staticmethod(self.discover)
@@ -0,0 +1,173 @@
+"""Preforking WSGI server.
+
+The master process binds the listening socket, warms the app and forks a
+fixed number of workers that all accept from that socket. Each worker
+handles every request in its own thread, so long-lived responses like the
+live update stream don't hold a worker up. The master only watches its
+workers:
+
+SIGTERM, SIGINT
+    Stop: workers end their live update streams, finish the requests
+    they're handling and exit.
+SIGHUP
+    Graceful reload: fork a fresh set of workers from the warmed master,
+    then stop the old ones once the new ones are up. The listening socket
+    stays open throughout, so no connection is refused. Code is not
+    re-imported; restart the master to deploy new code.
+
+Workers that die are replaced.
+"""
+
+import os
+import time
+import errno
+import fcntl
+import signal
+import socket
+from werkzeug.serving import make_server
+from .warmup import before_fork, after_fork, before_stop
+
+
+class PreforkServer(object):
+    """Master process of the preforking server."""
+
+    def __init__(self, app, host='127.0.0.1', port=5000, workers=4,
+                 stop_timeout=30):
+        """Bind the listening socket."""
+        self.app = app
+        self.host = host
+        self.workers = workers
+        self.stop_timeout = stop_timeout
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(128)
+        self.sock.set_inheritable(True)
+        self.port = self.sock.getsockname()[1]
+        self.children = set()
+        self.retiring = set()
+        self._stopping = False
+        self._reloading = False
+
+    def log(self, message, *args):
+        """Log through the app logger."""
+        self.app.logger.info(message.format(*args))
+
+    def run(self):
+        """Fork the workers and look after them until told to stop."""
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        signal.signal(signal.SIGHUP, self._handle_reload)
+        self.log('master {0} listening on {1}:{2}',
+                 os.getpid(), self.host, self.port)
+        before_fork()
+        for i in range(self.workers):
+            self.spawn()
+        while not self._stopping:
+            if self._reloading:
+                self._reloading = False
+                self.reload()
+            for pid in self._reap():
+                if pid in self.retiring:
+                    self.retiring.discard(pid)
+                elif not self._stopping:
+                    self.log('worker {0} died, replacing it', pid)
+                    self.spawn()
+            time.sleep(0.5)
+        self.stop()
+
+    def _handle_stop(self, signum, frame):
+        """Stop on SIGTERM or SIGINT."""
+        self._stopping = True
+
+    def _handle_reload(self, signum, frame):
+        """Reload on SIGHUP."""
+        self._reloading = True
+
+    def spawn(self):
+        """Fork a new worker."""
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                self.serve()
+            except Exception:
+                self.app.logger.exception('worker crashed')
+                status = 1
+            finally:
+                os._exit(status)
+        self.children.add(pid)
+        return pid
+
+    def _reap(self):
+        """Collect exited workers, returning their pids."""
+        exited = []
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+            if pid == 0:
+                break
+            self.children.discard(pid)
+            exited.append(pid)
+        return exited
+
+    def _signal_children(self, pids, signum):
+        """Send a signal to workers that may have exited already."""
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def reload(self):
+        """Replace every worker without closing the listening socket."""
+        old = set(self.children)
+        self.log('reloading {0} workers', len(old))
+        for i in range(self.workers):
+            self.spawn()
+        self.retiring |= old
+        self._signal_children(old, signal.SIGTERM)
+
+    def stop(self):
+        """Stop every worker, killing those that don't stop in time."""
+        self._signal_children(self.children, signal.SIGTERM)
+        deadline = time.time() + self.stop_timeout
+        while self.children and time.time() < deadline:
+            self._reap()
+            time.sleep(0.1)
+        self._signal_children(self.children, signal.SIGKILL)
+        self._reap()
+        self.sock.close()
+        self.log('master {0} stopped', os.getpid())
+
+    def serve(self):
+        """Handle requests in a worker until told to stop."""
+        start = time.time()
+        self._stopping = False
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        after_fork()
+        server = make_server(self.host, self.port, self.app,
+                             threaded=True, fd=self.sock.fileno())
+        # Keep track of request threads so they can be waited for
+        server.daemon_threads = False
+        # Workers race to accept; the losers must not block in accept().
+        # Set on the file rather than the socket object so the server still
+        # waits up to its timeout for a connection.
+        fd = server.socket.fileno()
+        fcntl.fcntl(fd, fcntl.F_SETFL,
+                    fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        server.timeout = 1
+        self.log('worker {0} ready in {1:.1f} ms',
+                 os.getpid(), (time.time() - start) * 1000)
+        while not self._stopping:
+            server.handle_request()
+        before_stop()
+        server.server_close()
+        self.log('worker {0} stopped', os.getpid())
@@ -0,0 +1,110 @@
+"""Publish/subscribe for live updates.
+
+Subscribers are served from a broker in their own process. Processes that
+don't share memory, like the workers of the preforking server, each run a
+relay that polls the database for new posts and publishes them locally, so
+a client sees posts written through any worker.
+"""
+
+import os
+import time
+import queue
+import logging
+import threading
+
+
+class Broker(object):
+    """Fan out messages to every subscriber in this process.
+
+    Each subscriber gets its own bounded queue. A subscriber that falls
+    behind drops messages rather than holding up publishers; clients are
+    expected to catch up through the since-id endpoint.
+
+    Closing the broker sends every subscriber None, telling it to stop.
+    """
+
+    def __init__(self, maxsize=100):
+        """Initialize the broker."""
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._subscribers = set()
+
+    def subscribe(self):
+        """Return a new queue that receives every published message."""
+        q = queue.Queue(self.maxsize)
+        with self._lock:
+            self._subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q):
+        """Stop delivering messages to a queue."""
+        with self._lock:
+            self._subscribers.discard(q)
+
+    def publish(self, message):
+        """Send a message to all current subscribers."""
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait(message)
+            except queue.Full:
+                pass
+
+    def close(self):
+        """Tell every subscriber to stop, even one that has fallen behind."""
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            while True:
+                try:
+                    q.put_nowait(None)
+                    break
+                except queue.Full:
+                    try:
+                        q.get_nowait()
+                    except queue.Empty:
+                        pass
+
+
+class Relay(object):
+    """Call a poll function every interval seconds from a background thread.
+
+    ``poll`` takes the key it last returned, None the first time, and
+    returns the key to pass next, e.g. the last id it saw.
+    """
+
+    def __init__(self, poll, interval=1.0):
+        """Initialize the relay."""
+        self.poll = poll
+        self.interval = interval
+        self.key = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def poll_once(self):
+        """Poll once in the calling thread."""
+        self.key = self.poll(self.key)
+
+    def start(self):
+        """Start polling unless this process already does.
+
+        Threads don't survive a fork, so a forked worker starts its own.
+        """
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='relay')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        """Poll until the process exits."""
+        while True:
+            try:
+                self.poll_once()
+            except Exception:
+                logging.getLogger(__name__).exception('relay poll failed')
+            time.sleep(self.interval)
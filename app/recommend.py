@@ -0,0 +1,93 @@
+"""Offline "who to follow" recommendations.
+
+The follow graph is loaded into a sparse adjacency matrix A, where
+A[u, v] = 1 if u follows v. Squaring it counts the two-hop paths between
+users: (A A)[u, v] is the number of people u follows who follow v. The best
+scoring users that u doesn't follow yet are stored in the recommendation
+table, which the profile page reads.
+"""
+
+import numpy as np
+import scipy.sparse as sp
+from sqlalchemy import select
+from app import db
+from .models import followers, recommendations
+
+
+def two_hop_recommendations(follower_ids, followed_ids, top_n=10,
+                            block_size=10000):
+    """Return the top_n friends-of-friends of every user in an edge list.
+
+    Takes the follow graph as two parallel arrays of user ids and returns
+    three parallel arrays: user id, recommended user id and score. Users are
+    processed block_size rows at a time to bound the size of A A, with each
+    block computed with whole-matrix operations.
+    """
+    follower_ids = np.asarray(follower_ids, dtype=np.int64)
+    followed_ids = np.asarray(followed_ids, dtype=np.int64)
+    empty = np.array([], dtype=np.int64)
+    if not len(follower_ids):
+        return empty, empty, empty
+
+    ids, inverse = np.unique(np.concatenate([follower_ids, followed_ids]),
+                             return_inverse=True)
+    n = len(ids)
+    m = len(follower_ids)
+    adjacency = sp.csr_matrix((np.ones(m, dtype=np.int32),
+                               (inverse[:m], inverse[m:])), shape=(n, n))
+    # Duplicate edges were summed; a follow counts once
+    adjacency.data[:] = 1
+
+    users, recommended, scores = [], [], []
+    for start in range(0, n, block_size):
+        block = adjacency[start:start + block_size]
+        paths = block.dot(adjacency)
+        # Drop users already followed, and the users themselves
+        k = block.shape[0]
+        mask = block + sp.csr_matrix(
+            (np.ones(k, dtype=np.int32),
+             (np.arange(k), np.arange(start, start + k))), shape=(k, n))
+        mask.data[:] = 1
+        paths = sp.csr_matrix(paths - paths.multiply(mask))
+        paths.eliminate_zeros()
+
+        # Rank each row's entries by score (ties to the lower id) and keep
+        # the first top_n of every row
+        row_of = np.repeat(np.arange(paths.shape[0]), np.diff(paths.indptr))
+        order = np.lexsort((paths.indices, -paths.data, row_of))
+        rank = np.arange(len(order)) - paths.indptr[row_of[order]]
+        keep = order[rank < top_n]
+        users.append(ids[row_of[keep] + start])
+        recommended.append(ids[paths.indices[keep]])
+        scores.append(paths.data[keep].astype(np.int64))
+    return np.concatenate(users), np.concatenate(recommended), \
+        np.concatenate(scores)
+
+
+def load_follow_graph():
+    """Return the follow graph as arrays of follower and followed ids."""
+    with db.engine.connect() as conn:
+        edges = np.array(conn.execute(
+            select([followers.c.follower_id, followers.c.followed_id])
+        ).fetchall(), dtype=np.int64).reshape(-1, 2)
+    return edges[:, 0], edges[:, 1]
+
+
+def compute_recommendations(top_n=10, batch_size=10000):
+    """Recompute and store recommendations for every user.
+
+    The old recommendations are replaced in a single transaction, so the
+    profile page never sees a half written table. Returns the number of
+    recommendations stored.
+    """
+    users, recommended, scores = two_hop_recommendations(
+        *load_follow_graph(), top_n=top_n)
+    rows = [{'user_id': u, 'recommended_id': r, 'score': s}
+            for u, r, s in zip(users.tolist(), recommended.tolist(),
+                               scores.tolist())]
+    with db.engine.begin() as conn:
+        conn.execute(recommendations.delete())
+        for start in range(0, len(rows), batch_size):
+            conn.execute(recommendations.insert(),
+                         rows[start:start + batch_size])
+    return len(rows)
@@ -0,0 +1,47 @@
+"""Streamed template rendering."""
+
+from flask import render_template, stream_with_context, Response, \
+    get_flashed_messages
+from app import app
+
+
+def _coalesce(chunks, size):
+    """Join the small strings Jinja yields into chunks of at least size."""
+    buf = []
+    buffered = 0
+    for chunk in chunks:
+        buf.append(chunk)
+        buffered += len(chunk)
+        if buffered >= size:
+            yield ''.join(buf)
+            buf = []
+            buffered = 0
+    if buf:
+        yield ''.join(buf)
+
+
+def stream_template(template_name, **context):
+    """Render a template as a generator of HTML chunks."""
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    return _coalesce(template.generate(context),
+                     app.config['STREAM_CHUNK_SIZE'])
+
+
+def render_page(template_name, **context):
+    """Render a full page, streaming it if STREAM_TEMPLATES is enabled.
+
+    When streaming, the header and nav go out as soon as they are rendered
+    and the rest of the page follows as the template walks the post list.
+    Errors raised mid-stream can't be turned into a 500 page anymore, so
+    streaming is opt-in.
+
+    The session is saved before a streamed body is rendered, so flashed
+    messages are popped here; the template's get_flashed_messages() then
+    reads them from the request context.
+    """
+    if not app.config['STREAM_TEMPLATES']:
+        return render_template(template_name, **context)
+    get_flashed_messages(with_categories=True)
+    return Response(stream_with_context(
+        stream_template(template_name, **context)))
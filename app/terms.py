@@ -0,0 +1,117 @@
+"""Hashtag and mention extraction.
+
+The hashtags and @mentions in a post are parsed once, when the post is
+written, into the post_tag and mention tables. Tag and mention timelines
+are then index lookups instead of full text scans.
+"""
+
+import re
+from sqlalchemy import select
+from app import db
+from .models import User, Tag, post_tags, mentions
+from .online_migrations import OnlineMigration, register
+
+TAG_RE = re.compile(r'(?:^|(?<=\W))#(\w+)', re.UNICODE)
+MENTION_RE = re.compile(r'(?:^|(?<=\W))@([a-zA-Z0-9_\.]+)')
+
+
+def normalize_tag(name):
+    """Return the stored form of a hashtag, without the #.
+
+    Tags are lowercased so #Flask and #flask are the same tag, and cut to
+    the length of Tag.name.
+    """
+    return name.lower()[:64]
+
+
+def parse_terms(body):
+    """Return the set of hashtags and the set of nicknames in a post body."""
+    tags = set(normalize_tag(t) for t in TAG_RE.findall(body))
+    nicknames = set(n.rstrip('.') for n in MENTION_RE.findall(body))
+    nicknames.discard('')
+    return tags, nicknames
+
+
+def index_terms(conn, posts):
+    """Index the hashtags and mentions of (id, body) pairs.
+
+    Any existing rows for these posts are replaced, so indexing a post twice
+    is harmless. conn can be a connection or the db session; the caller
+    commits.
+    """
+    parsed = dict((post_id, parse_terms(body)) for post_id, body in posts)
+    if not parsed:
+        return
+    post_ids = list(parsed)
+    conn.execute(post_tags.delete().where(post_tags.c.post_id.in_(post_ids)))
+    conn.execute(mentions.delete().where(mentions.c.post_id.in_(post_ids)))
+
+    names = set()
+    nicknames = set()
+    for tags, nicks in parsed.values():
+        names |= tags
+        nicknames |= nicks
+
+    tag_ids = {}
+    if names:
+        tag_table = Tag.__table__
+        tag_ids = dict(conn.execute(
+            select([tag_table.c.name, tag_table.c.id])
+            .where(tag_table.c.name.in_(names))).fetchall())
+        missing = names - set(tag_ids)
+        if missing:
+            conn.execute(tag_table.insert(),
+                         [{'name': name} for name in missing])
+            tag_ids = dict(conn.execute(
+                select([tag_table.c.name, tag_table.c.id])
+                .where(tag_table.c.name.in_(names))).fetchall())
+        rows = [{'post_id': post_id, 'tag_id': tag_ids[name]}
+                for post_id, (tags, nicks) in parsed.items()
+                for name in tags]
+        conn.execute(post_tags.insert(), rows)
+
+    if nicknames:
+        user_table = User.__table__
+        user_ids = dict(conn.execute(
+            select([user_table.c.nickname, user_table.c.id])
+            .where(user_table.c.nickname.in_(nicknames))).fetchall())
+        rows = [{'post_id': post_id, 'user_id': user_ids[nick]}
+                for post_id, (tags, nicks) in parsed.items()
+                for nick in nicks if nick in user_ids]
+        if rows:
+            conn.execute(mentions.insert(), rows)
+
+
+@register
+class PostTermsBackfill(OnlineMigration):
+    """Index hashtags and mentions of posts written before they were parsed."""
+
+    name = 'post_terms_backfill'
+    table = 'post'
+
+    def total(self, conn):
+        """Count the posts to index."""
+        table = db.metadata.tables[self.table]
+        return conn.execute(select([db.func.count()])
+                            .select_from(table)).scalar()
+
+    def backfill(self, conn, after, batch_size):
+        """Index the next batch of posts."""
+        table = db.metadata.tables[self.table]
+        query = select([table.c.id, table.c.body]) \
+            .order_by(table.c.id).limit(batch_size)
+        if after is not None:
+            query = query.where(table.c.id > after)
+        posts = conn.execute(query).fetchall()
+        if not posts:
+            return after, 0
+        index_terms(conn, posts)
+        return posts[-1][0], len(posts)
+
+
+@register
+class ArchivedPostTermsBackfill(PostTermsBackfill):
+    """Index hashtags and mentions of archived posts."""
+
+    name = 'post_archive_terms_backfill'
+    table = 'post_archive'
@@ -0,0 +1,205 @@
+"""Trending terms over the stream of new posts.
+
+Every new post adds its words and hashtags to a Count-Min sketch, which
+estimates how often any term was seen in a fixed amount of memory. Counts
+decay exponentially with a configurable half-life, so old bursts fade out.
+The k terms with the highest estimates are tracked on the side, which is
+all a page needs to render the trending panel.
+
+Decay uses forward decay: instead of shrinking every counter as time
+passes, each new occurrence is added with a weight that grows over time,
+and scores are scaled back down when read. When the weights get large the
+whole structure is rescaled once. Since every stored score is scaled the
+same way, the ranking only changes when a post is counted; it is sorted
+then, at most once between two reads, rather than on every page view.
+"""
+
+import re
+import time
+import struct
+import hashlib
+import datetime
+import threading
+from app import db
+from .models import trending_terms
+from .terms import normalize_tag
+
+WORD_RE = re.compile(r'#?\w{3,}', re.UNICODE)
+STOPWORDS = frozenset("""
+    the and for are but not you all any can had her was one our out has him
+    his how its may new now old see two way who did get let say she too use
+    that with have this will your from they been were said what when than
+    them then there their these some would about which into just like more
+    also over only very even most after because where while here
+""".split())
+
+
+def extract_terms(body):
+    """Return the distinct terms of a post worth counting."""
+    terms = set()
+    for word in WORD_RE.findall(body.lower()):
+        if word.lstrip('#') in STOPWORDS or word.lstrip('#').isdigit():
+            continue
+        if word.startswith('#'):
+            terms.add('#' + normalize_tag(word[1:]))
+        else:
+            terms.add(word[:64])
+    return terms
+
+
+class CountMinSketch(object):
+    """Approximate counts of many keys in a fixed size table.
+
+    Estimates are never too low, and too high by at most a small fraction
+    of the total count with high probability.
+    """
+
+    def __init__(self, width=4096, depth=4):
+        """Initialize an empty sketch."""
+        self.width = width
+        self.depth = depth
+        self.rows = [[0.0] * width for i in range(depth)]
+
+    def _buckets(self, key):
+        """Yield the bucket of key in every row."""
+        data = key.encode('utf-8')
+        for i in range(self.depth):
+            digest = hashlib.md5(struct.pack('>I', i) + data).digest()
+            yield struct.unpack('>I', digest[:4])[0] % self.width
+
+    def add(self, key, amount=1.0):
+        """Add amount to key, returning its new estimate."""
+        estimate = None
+        for row, bucket in zip(self.rows, self._buckets(key)):
+            row[bucket] += amount
+            if estimate is None or row[bucket] < estimate:
+                estimate = row[bucket]
+        return estimate
+
+    def estimate(self, key):
+        """Return the estimated count of key."""
+        return min(row[bucket]
+                   for row, bucket in zip(self.rows, self._buckets(key)))
+
+    def scale(self, factor):
+        """Multiply every counter by factor."""
+        for row in self.rows:
+            for i in range(self.width):
+                row[i] *= factor
+
+
+class TrendingTerms(object):
+    """Decayed heavy hitters over the post stream."""
+
+    def __init__(self, k=50, half_life=3600, snapshot_interval=300,
+                 width=4096, depth=4):
+        """Initialize the tracker."""
+        self.k = k
+        self.half_life = float(half_life)
+        self.snapshot_interval = snapshot_interval
+        self.sketch = CountMinSketch(width, depth)
+        self.top_k = {}
+        self._ranked = []
+        self._min_term = None
+        self._epoch = time.time()
+        self._last_snapshot = self._epoch
+        self._lock = threading.Lock()
+
+    def _weight(self, now):
+        """Weight of an occurrence at time now, relative to the epoch."""
+        return 2.0 ** ((now - self._epoch) / self.half_life)
+
+    def _rescale(self, now):
+        """Move the epoch to now so weights stay small."""
+        factor = 1.0 / self._weight(now)
+        self.sketch.scale(factor)
+        for term in self.top_k:
+            self.top_k[term] *= factor
+        self._ranked = None
+        self._epoch = now
+
+    def _update_min(self):
+        """Find the lowest scoring tracked term."""
+        self._min_term = min(self.top_k, key=self.top_k.get) \
+            if self.top_k else None
+
+    def _count(self, term, amount):
+        """Count a term and keep the top k up to date."""
+        self._ranked = None
+        estimate = self.sketch.add(term, amount)
+        if term in self.top_k:
+            self.top_k[term] = estimate
+            if term == self._min_term:
+                self._update_min()
+        elif len(self.top_k) < self.k:
+            self.top_k[term] = estimate
+            self._update_min()
+        elif estimate > self.top_k[self._min_term]:
+            del self.top_k[self._min_term]
+            self.top_k[term] = estimate
+            self._update_min()
+
+    def observe(self, body, now=None):
+        """Count the terms of a new post."""
+        if now is None:
+            now = time.time()
+        with self._lock:
+            weight = self._weight(now)
+            if weight > 2.0 ** 32:
+                self._rescale(now)
+                weight = 1.0
+            for term in extract_terms(body):
+                self._count(term, weight)
+
+    def top(self, n=10, now=None):
+        """Return up to n (term, score) pairs, highest score first.
+
+        Scores are decayed to now, so they read as recent occurrences. Terms
+        with equal scores are ordered alphabetically.
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            weight = self._weight(now)
+            if self._ranked is None:
+                self._ranked = sorted(self.top_k.items(),
+                                      key=lambda item: (-item[1], item[0]))
+            items = self._ranked[:n]
+        return [(term, score / weight) for term, score in items]
+
+    def snapshot(self, now=None):
+        """Replace the stored trending terms with the current top k."""
+        if now is None:
+            now = time.time()
+        taken = datetime.datetime.utcfromtimestamp(now)
+        rows = [{'term': term, 'score': score, 'taken': taken}
+                for term, score in self.top(self.k, now)]
+        with db.engine.begin() as conn:
+            conn.execute(trending_terms.delete())
+            if rows:
+                conn.execute(trending_terms.insert(), rows)
+        self._last_snapshot = now
+
+    def maybe_snapshot(self, now=None):
+        """Snapshot if the last one is older than snapshot_interval."""
+        if now is None:
+            now = time.time()
+        if now - self._last_snapshot >= self.snapshot_interval:
+            self.snapshot(now)
+            return True
+        return False
+
+    def restore(self, now=None):
+        """Seed the tracker from the last snapshot, decayed to now."""
+        if now is None:
+            now = time.time()
+        with db.engine.connect() as conn:
+            rows = conn.execute(trending_terms.select()).fetchall()
+        with self._lock:
+            weight = self._weight(now)
+            for row in rows:
+                age = now - (row.taken - datetime.datetime(1970, 1, 1)) \
+                    .total_seconds()
+                score = row.score * 2.0 ** (-max(age, 0) / self.half_life)
+                self._count(row.term, score * weight)
+        self._last_snapshot = now
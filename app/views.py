@@ -1,15 +1,22 @@
 """Views for Flask microblog app."""
 
 from flask import render_template, flash, redirect, \
-    session, url_for, request, g
+    session, url_for, request, g, jsonify, Response
 import flask_login
 import flask_babel
 import datetime
-from config import POSTS_PER_PAGE, MAX_SEARCH_RESULTS, LANGUAGES
-from app import app, db, lm, oid, babel
+import json
+import queue
+from config import POSTS_PER_PAGE, MAX_SEARCH_RESULTS, LANGUAGES, \
+    SSE_KEEPALIVE, TRENDING_SHOWN, LIVE_POLL_INTERVAL
+from app import app, db, lm, oid, babel, broker, trending
+from .pubsub import Relay
 from .forms import LoginForm, EditForm, PostForm, SearchForm
-from .models import User, Post
+from .models import User, Post, ArchivedPost, Tag, post_tags, mentions
+from .archive import ArchivePagination, search_posts, cursor_page
+from .terms import index_terms, normalize_tag
 from .emails import follower_notification
+from .streaming import render_page
 
 
 #                     _
@@ -47,6 +54,22 @@ def internal_error(error):
 #          _/_
 #         (/
 
+@app.before_first_request
+def restore_trending():
+    """Pick up the trending terms from before the last restart."""
+    trending.restore()
+
+
+@app.before_first_request
+def start_relay():
+    """Follow new posts written through any process.
+
+    Tests call relay.poll_once() themselves instead.
+    """
+    if not app.testing:
+        relay.start()
+
+
 @app.before_request
 def before_request():
     """Keep the current user up-to-date by using flask_login."""
@@ -140,10 +163,11 @@ def search():
 @flask_login.login_required
 def search_results(query):
     """Perform a search using the Whoosh search engine."""
-    results = Post.query.whoosh_search(query, MAX_SEARCH_RESULTS).all()
-    return render_template('search_results.html',
-                           query=query,
-                           results=results)
+    # Left lazy so a streamed page fetches rows after the header is out
+    results = search_posts(query, MAX_SEARCH_RESULTS)
+    return render_page('search_results.html',
+                       query=query,
+                       results=results)
 
 
 #                          _
@@ -162,10 +186,13 @@ def user(name, page=1):
     if user is None:
         flash('User {0} not found'.format(name))
         return redirect(url_for('index'))
-    posts = user.posts.paginate(page, POSTS_PER_PAGE, False)
-    return render_template('user.html',
-                           user=user,
-                           posts=posts)
+    posts = ArchivePagination(user.posts.order_by(Post.timestamp.desc()),
+                              user.archived_posts
+                              .order_by(ArchivedPost.timestamp.desc()),
+                              page, POSTS_PER_PAGE)
+    return render_page('user.html',
+                       user=user,
+                       posts=posts)
 
 
 @app.route('/edit', methods=['GET', 'POST'])
@@ -248,11 +275,157 @@ def index(page=1):
                     timestamp=datetime.datetime.utcnow(),
                     author=g.user)
         db.session.add(post)
+        db.session.flush()
+        index_terms(db.session, [(post.id, post.body)])
         db.session.commit()
         flash('Your post is now live')
         return redirect(url_for('index'))
-    posts = g.user.followed_posts().paginate(page, POSTS_PER_PAGE, False)
-    return render_template('index.html',
-                           title="Yo yo yo",
-                           form=form,
-                           posts=posts)
+    posts = ArchivePagination(g.user.followed_posts(),
+                              g.user.followed_archived_posts(),
+                              page, POSTS_PER_PAGE)
+    return render_page('index.html',
+                       title="Yo yo yo",
+                       form=form,
+                       posts=posts,
+                       trending=trending.top(TRENDING_SHOWN))
+
+
+#    _
+#   //  ._,     _
+# _(/__/_ (_/__(/_
+
+
+@app.route('/index/since/<int:since_id>')
+@flask_login.login_required
+def index_since(since_id):
+    """Return followed posts newer than since_id as JSON, oldest first.
+
+    At most POSTS_PER_PAGE posts are returned; clients keep asking with the
+    returned last_id until no posts come back.
+    """
+    posts = g.user.followed_posts_since(since_id).limit(POSTS_PER_PAGE).all()
+    return jsonify(posts=[p.to_dict() for p in posts],
+                   last_id=posts[-1].id if posts else since_id)
+
+
+def _relay_new_posts(after):
+    """Publish and count the posts written after post id after.
+
+    Every process runs this, so live updates and trending terms include the
+    posts written through the other workers. Returns the id to continue
+    from.
+    """
+    with app.app_context():
+        if after is None:
+            return db.session.query(db.func.max(Post.id)).scalar() or 0
+        posts = Post.query.filter(Post.id > after).order_by(Post.id).all()
+        for post in posts:
+            broker.publish({'user_id': post.user_id, 'post': post.to_dict()})
+            trending.observe(post.body)
+        trending.maybe_snapshot()
+        return posts[-1].id if posts else after
+
+
+relay = Relay(_relay_new_posts, LIVE_POLL_INTERVAL)
+
+
+def _sse_event(post):
+    """Format a post as a server-sent event."""
+    return 'id: {0}\nevent: post\ndata: {1}\n\n'.format(
+        post['id'], json.dumps(post))
+
+
+def _event_stream(q, followed_ids, backlog, last_id=None):
+    """Yield posts by followed users as they are published.
+
+    Posts up to last_id, and those in the backlog, were already sent or
+    read from the database; the relay may still publish them, so they are
+    skipped when they come through the queue. Ends when the broker is
+    closed; the client reconnects with Last-Event-ID, to another worker if
+    this one is stopping.
+    """
+    try:
+        for post in backlog:
+            yield _sse_event(post)
+            last_id = post['id']
+        while True:
+            try:
+                message = q.get(timeout=SSE_KEEPALIVE)
+            except queue.Empty:
+                yield ': keepalive\n\n'
+                continue
+            if message is None:
+                return
+            post = message['post']
+            if last_id is not None and post['id'] <= last_id:
+                continue
+            if message['user_id'] in followed_ids:
+                last_id = post['id']
+                yield _sse_event(post)
+    finally:
+        broker.unsubscribe(q)
+
+
+@app.route('/index/stream')
+@flask_login.login_required
+def index_stream():
+    """Push new posts by followed users as server-sent events.
+
+    The set of followed users is read once when the client connects. A
+    reconnecting client sends Last-Event-ID and first gets whatever it
+    missed in the meantime.
+    """
+    q = broker.subscribe()
+    followed_ids = set(u.id for u in g.user.followed)
+    since_id = request.headers.get('Last-Event-ID', type=int)
+    backlog = []
+    if since_id is not None:
+        backlog = [p.to_dict() for p in
+                   g.user.followed_posts_since(since_id)
+                   .limit(POSTS_PER_PAGE)]
+    return Response(_event_stream(q, followed_ids, backlog, since_id),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
+
+#  -/-__,   __   ,
+# _/_(_/(__(_/__/_)_
+#          _/_
+#         (/
+
+
+def _term_posts(table, column, value, before):
+    """Return a page of posts, hot then archived, found through an index."""
+    hot = Post.query.join(table, table.c.post_id == Post.id) \
+        .filter(column == value)
+    cold = ArchivedPost.query.join(table, table.c.post_id == ArchivedPost.id) \
+        .filter(column == value)
+    return cursor_page(hot, Post.id, cold, ArchivedPost.id,
+                       before, POSTS_PER_PAGE)
+
+
+@app.route('/tag/<name>')
+@flask_login.login_required
+def tag(name):
+    """Show the posts with a hashtag, newest first."""
+    tag = Tag.query.filter_by(name=normalize_tag(name)).first()
+    posts, next_cursor = [], None
+    if tag is not None:
+        posts, next_cursor = _term_posts(post_tags, post_tags.c.tag_id,
+                                         tag.id,
+                                         request.args.get('before', type=int))
+    return render_template('tag.html',
+                           tag=name,
+                           posts=posts,
+                           next_cursor=next_cursor)
+
+
+@app.route('/mentions')
+@flask_login.login_required
+def mentions_timeline():
+    """Show the posts mentioning the current user, newest first."""
+    posts, next_cursor = _term_posts(mentions, mentions.c.user_id, g.user.id,
+                                     request.args.get('before', type=int))
+    return render_template('mentions.html',
+                           posts=posts,
+                           next_cursor=next_cursor)
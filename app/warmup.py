@@ -0,0 +1,82 @@
+"""Warm up the application before it serves its first request.
+
+Without this, the first request each worker handles pays for compiling
+templates, loading Babel locale data, opening the search indexes and
+setting up the database engine. Warming the app in a master process that
+then forks its workers pays those costs once, and the workers share the
+result through copy-on-write memory.
+"""
+
+import time
+import flask_babel
+import flask_whooshalchemyplus
+from sqlalchemy.orm import configure_mappers
+from app import db, broker
+from .models import Post, ArchivedPost
+
+
+def _timed(timings, name, func, *args):
+    """Run func and record how long it took in milliseconds."""
+    start = time.time()
+    result = func(*args)
+    timings[name] = (time.time() - start) * 1000
+    return result
+
+
+def compile_templates(app):
+    """Compile every template into the Jinja cache."""
+    names = [name for name in app.jinja_env.list_templates()
+             if name.endswith(('.html', '.txt'))]
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+
+def load_translations(app):
+    """Load the Babel catalogs and locale data of every language."""
+    for locale in app.config['LANGUAGES']:
+        with app.test_request_context(
+                headers={'Accept-Language': locale}):
+            flask_babel.get_translations()
+            flask_babel.format_datetime()
+    return len(app.config['LANGUAGES'])
+
+
+def open_search_indexes(app):
+    """Open the Whoosh index of every searchable model."""
+    for model in (Post, ArchivedPost):
+        flask_whooshalchemyplus.whoosh_index(app, model)
+    return 2
+
+
+def prime_database():
+    """Build the mappers and open a pooled database connection."""
+    configure_mappers()
+    with db.engine.connect() as conn:
+        conn.execute('SELECT 1')
+
+
+def warm(app):
+    """Warm the app in the current process, returning timings in ms."""
+    timings = {}
+    _timed(timings, 'templates', compile_templates, app)
+    _timed(timings, 'translations', load_translations, app)
+    _timed(timings, 'search', open_search_indexes, app)
+    _timed(timings, 'database', prime_database)
+    return timings
+
+
+def before_fork():
+    """Close pooled connections so no child inherits an open connection."""
+    db.engine.dispose()
+
+
+def after_fork():
+    """Open this worker's own database connection."""
+    db.engine.dispose()
+    prime_database()
+
+
+def before_stop():
+    """End the live update streams so the worker can finish its requests."""
+    broker.close()
@@ -18,6 +18,11 @@ OPENID_PROVIDERS = [
     {'name': 'AOL', 'url': 'http://openid.aol.com/<username>'},
     {'name': 'Flickr', 'url': 'http://www.flickr.com/<username>'},
     {'name': 'MyOpenID', 'url': 'https://www.myopenid.com'}]
+# seconds between deleting expired nonces and associations, and how long
+# and for how many URLs discovery of a provider is cached
+OPENID_CLEANUP_INTERVAL = 3600
+OPENID_DISCOVERY_TTL = 3600
+OPENID_DISCOVERY_CACHE_SIZE = 1000
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'app.db')
@@ -27,6 +32,28 @@ SQLALCHEMY_TRACK_MODIFICATIONS = True
 # /index pagination
 POSTS_PER_PAGE = 20
 
+# posts older than this are moved to the archive table
+ARCHIVE_AFTER_DAYS = 90
+ARCHIVE_BATCH_SIZE = 500
+
+# who to follow
+RECOMMENDATIONS_PER_USER = 10
+RECOMMENDATIONS_SHOWN = 5
+
+# trending terms, decayed with a half-life in seconds
+TRENDING_TOP_K = 50
+TRENDING_SHOWN = 10
+TRENDING_HALF_LIFE = 3600
+TRENDING_SNAPSHOT_INTERVAL = 300
+
+# JSON API
+API_MAX_LIMIT = 100
+
+# live timeline updates; every process polls for new posts every
+# LIVE_POLL_INTERVAL seconds
+SSE_KEEPALIVE = 15
+LIVE_POLL_INTERVAL = 1
+
 # search config
 WHOOSH_BASE = os.path.join(basedir, 'search.db')
 MAX_SEARCH_RESULTS = 50
@@ -36,3 +63,9 @@ LANGUAGES = {
     'en': 'English',
     'es': 'Español'
 }
+
+# response streaming and compression
+STREAM_TEMPLATES = False
+STREAM_CHUNK_SIZE = 2048
+GZIP_LEVEL = 6
+GZIP_MIN_SIZE = 500
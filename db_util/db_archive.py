@@ -0,0 +1,20 @@
+#!/usr/bin/env python3
+"""Move old posts into the archive table."""
+
+import sys
+import os.path
+import argparse
+import datetime
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from config import ARCHIVE_AFTER_DAYS, ARCHIVE_BATCH_SIZE
+from app.archive import archive_posts
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('--days', type=int, default=ARCHIVE_AFTER_DAYS,
+                    help='archive posts older than this many days')
+parser.add_argument('--batch-size', type=int, default=ARCHIVE_BATCH_SIZE)
+args = parser.parse_args()
+
+moved = archive_posts(datetime.timedelta(days=args.days), args.batch_size)
+print('Archived {0} posts older than {1} days'.format(moved, args.days))
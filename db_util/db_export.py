@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+"""Export users, follows and posts to a directory."""
+
+import sys
+import os.path
+import argparse
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from app import bulk
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('directory')
+parser.add_argument('--format', choices=bulk.FORMATS, default='ndjson')
+parser.add_argument('--batch-size', type=int, default=1000)
+args = parser.parse_args()
+
+if not os.path.exists(args.directory):
+    os.makedirs(args.directory)
+for table in bulk.TABLES:
+    path = os.path.join(args.directory,
+                        '{0}.{1}'.format(table, args.format))
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        count = bulk.write_rows(table,
+                                bulk.export_rows(table, args.batch_size),
+                                f, args.format)
+    print('Exported {0} {1} rows to {2}'.format(count, table, path))
@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+"""Import users, follows and posts exported by db_export.py."""
+
+import sys
+import os.path
+import argparse
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from app import bulk
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('directory')
+parser.add_argument('--format', choices=bulk.FORMATS, default='ndjson')
+parser.add_argument('--batch-size', type=int, default=1000)
+parser.add_argument('--no-reindex', action='store_true',
+                    help='skip rebuilding the search index')
+args = parser.parse_args()
+
+for table in bulk.TABLES:
+    path = os.path.join(args.directory,
+                        '{0}.{1}'.format(table, args.format))
+    with open(path, newline='', encoding='utf-8') as f:
+        count = bulk.import_rows(table,
+                                 bulk.read_rows(table, f, args.format),
+                                 args.batch_size)
+    print('Imported {0} {1} rows from {2}'.format(count, table, path))
+if not args.no_reindex:
+    count = bulk.reindex_posts(args.batch_size)
+    print('Reindexed {0} posts'.format(count))
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+"""Run online migrations, resuming any that were interrupted."""
+
+import sys
+import os.path
+import argparse
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from app.online_migrations import MIGRATIONS, run_migration
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('names', nargs='*',
+                    help='migrations to run (default: all)')
+parser.add_argument('--list', action='store_true',
+                    help='list available migrations and exit')
+parser.add_argument('--batch-size', type=int, default=1000)
+parser.add_argument('--sleep', type=float, default=0,
+                    help='seconds to wait between batches')
+parser.add_argument('--no-contract', action='store_true',
+                    help='stop after the backfill phase')
+args = parser.parse_args()
+
+if args.list:
+    for name, migration in MIGRATIONS.items():
+        print('{0}: {1}'.format(name, migration.__doc__))
+    sys.exit()
+for name in args.names or list(MIGRATIONS):
+    if name not in MIGRATIONS:
+        sys.exit('Unknown migration {0}'.format(name))
+    phase = run_migration(MIGRATIONS[name](), args.batch_size,
+                          contract=not args.no_contract, sleep=args.sleep)
+    print('{0}: {1}'.format(name, phase))
@@ -0,0 +1,20 @@
+#!/usr/bin/env python3
+"""Recompute who to follow recommendations for every user."""
+
+import sys
+import os.path
+import time
+import argparse
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from config import RECOMMENDATIONS_PER_USER
+from app.recommend import compute_recommendations
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('--top-n', type=int, default=RECOMMENDATIONS_PER_USER)
+args = parser.parse_args()
+
+start = time.time()
+count = compute_recommendations(args.top_n)
+print('Stored {0} recommendations in {1:.1f}s'.format(
+    count, time.time() - start))
@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+"""Start the production server.
+
+Warms the app once in a master process, then forks the worker processes.
+Send SIGHUP to replace the workers gracefully, SIGTERM to stop.
+"""
+
+import os
+import time
+import argparse
+from app import app
+from app.warmup import warm
+from app.prefork import PreforkServer
+
+parser = argparse.ArgumentParser(description='Start the production server.')
+parser.add_argument('--host', default='127.0.0.1')
+parser.add_argument('--port', type=int, default=5000)
+parser.add_argument('--workers', type=int, default=os.cpu_count() or 2)
+args = parser.parse_args()
+
+server = PreforkServer(app, args.host, args.port, args.workers)
+start = time.time()
+timings = warm(app)
+app.logger.info('warmed up in {0:.1f} ms ({1})'.format(
+    (time.time() - start) * 1000,
+    ', '.join('{0} {1:.1f} ms'.format(k, v)
+              for k, v in sorted(timings.items()))))
+server.run()
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+"""Time the who to follow job on a synthetic follow graph.
+
+Follows are drawn with a heavy tail, so a few users have many followers as
+on a real site. Everyone also follows themselves, as the app does.
+"""
+
+import sys
+import os.path
+import time
+import argparse
+import numpy as np
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from app.recommend import two_hop_recommendations
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('--users', type=int, default=100000)
+parser.add_argument('--edges', type=int, default=1000000)
+parser.add_argument('--top-n', type=int, default=10)
+parser.add_argument('--block-size', type=int, default=10000)
+parser.add_argument('--seed', type=int, default=0)
+args = parser.parse_args()
+
+rng = np.random.RandomState(args.seed)
+follower_ids = rng.randint(1, args.users + 1, args.edges)
+popularity = np.minimum(rng.zipf(1.5, args.edges), args.users) - 1
+followed_ids = rng.permutation(args.users)[popularity] + 1
+everyone = np.arange(1, args.users + 1)
+follower_ids = np.concatenate([follower_ids, everyone])
+followed_ids = np.concatenate([followed_ids, everyone])
+
+start = time.time()
+users, recommended, scores = two_hop_recommendations(
+    follower_ids, followed_ids, args.top_n, args.block_size)
+elapsed = time.time() - start
+print('{0} users, {1} edges: {2} recommendations in {3:.2f}s'.format(
+    args.users, len(follower_ids), len(users), elapsed))
@@ -2,16 +2,47 @@
 
 import pytest
 import decorator
+import gzip
+import io
+import json
 import os
 import sys
+import time
+import signal
+import socket
 import os.path
 sys.path.append(
     os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
 
 from datetime import datetime, timedelta
 from config import basedir
-from app import app, db
-from app.models import User, Post
+import flask_login
+from flask import Response, session
+from werkzeug.test import Client
+from urllib.request import urlopen
+from app import app, db, broker, trending
+from app.views import relay, _event_stream
+from app.warmup import warm
+from app.prefork import PreforkServer
+from app.models import User, Post, ArchivedPost
+from app.archive import archive_posts, ArchivePagination, cursor_page
+from app.pubsub import Broker
+from app import bulk, api
+from app.trending import extract_terms, CountMinSketch, TrendingTerms
+from app.recommend import two_hop_recommendations, compute_recommendations
+from app.terms import parse_terms, PostTermsBackfill
+from app.models import Tag, post_tags, mentions
+from app.models import oid_associations, oid_nonces
+from app.online_migrations import OnlineMigration, run_migration, \
+    has_index, has_column_index, PostTimestampIndex, PostAutoincrement
+from app.compress import GzipMiddleware
+from app.streaming import stream_template
+from app.openid_store import SQLAlchemyStore, DiscoveryCache
+from app import openid_store
+from openid.association import Association
+from openid.consumer import consumer
+from openid.consumer.discover import OpenIDServiceEndpoint
+from openid.store import nonce
 
 
 #           _  ,_
@@ -52,6 +83,15 @@ def td(func):
     return decorator.decorator(myfunc, func)
 
 
+def login(client, user):
+    """Log a user in on the test client, skipping the OpenID dance."""
+    # Let Flask-Login pick its own session keys, which changed in 0.5
+    with client.session_transaction() as sess:
+        with app.test_request_context():
+            flask_login.login_user(user)
+            sess.update(session)
+
+
 #  -/- _   ,   -/- ,
 # _/__(/__/_)__/__/_)_
 
@@ -186,3 +226,972 @@ def test_follow_posts(setup):
     assert f2 == [p3, p2]
     assert f3 == [p4, p3]
     assert f4 == [p4]
+
+
+def test_gzip_buffered():
+    """Compress responses with a known length in one go."""
+    body = b'<p>hello</p>' * 100
+
+    def wsgi(environ, start_response):
+        return Response(body, mimetype='text/html')(environ, start_response)
+    client = Client(GzipMiddleware(wsgi), Response)
+
+    r = client.get('/', headers={'Accept-Encoding': 'gzip'})
+    assert r.headers['Content-Encoding'] == 'gzip'
+    assert int(r.headers['Content-Length']) == len(r.data)
+    assert gzip.decompress(r.data) == body
+
+    # Clients that don't ask for gzip get the plain body
+    r = client.get('/')
+    assert 'Content-Encoding' not in r.headers
+    assert r.data == body
+
+
+def test_gzip_streamed():
+    """Compress streamed responses chunk by chunk."""
+    chunks = [b'<p>chunk</p>' * 10 for i in range(5)]
+
+    def wsgi(environ, start_response):
+        return Response(iter(chunks), mimetype='text/html')(
+            environ, start_response)
+    client = Client(GzipMiddleware(wsgi), Response)
+
+    r = client.get('/', headers={'Accept-Encoding': 'gzip'})
+    assert r.headers['Content-Encoding'] == 'gzip'
+    assert 'Content-Length' not in r.headers
+    assert gzip.decompress(r.data) == b''.join(chunks)
+
+
+def test_gzip_skips_small_and_binary():
+    """Leave tiny and non-text responses alone."""
+    def wsgi(environ, start_response):
+        mimetype = 'image/png' if environ['PATH_INFO'] == '/img' \
+            else 'text/html'
+        return Response(b'x' * 10, mimetype=mimetype)(
+            environ, start_response)
+    client = Client(GzipMiddleware(wsgi, min_size=100), Response)
+
+    for path in ('/', '/img'):
+        r = client.get(path, headers={'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in r.headers
+        assert r.data == b'x' * 10
+
+
+def test_stream_template():
+    """Streamed templates render the same page in chunks."""
+    chunk_size = app.config['STREAM_CHUNK_SIZE']
+    app.config['STREAM_CHUNK_SIZE'] = 64
+    try:
+        with app.test_request_context('/'):
+            app.preprocess_request()
+            chunks = list(stream_template('404.html'))
+    finally:
+        app.config['STREAM_CHUNK_SIZE'] = chunk_size
+    assert len(chunks) > 1
+    assert '</html>' in chunks[-1]
+
+
+@td
+def test_streamed_index(setup):
+    """Stream the index page, showing a flashed message only once."""
+    u = User(nickname='john', email='john@example.com')
+    db.session.add(u)
+    db.session.commit()
+    u.follow(u)
+    db.session.add(u)
+    db.session.commit()
+    login(setup, u)
+    app.config['STREAM_TEMPLATES'] = True
+    try:
+        r = setup.post('/index', data={'post': 'hello'})
+        assert r.status_code == 302
+        r = setup.get('/index')
+        assert r.is_streamed
+        assert b'Your post is now live' in r.data
+        assert b'hello' in r.data
+        r = setup.get('/index')
+        assert b'Your post is now live' not in r.data
+        assert b'hello' in r.data
+    finally:
+        app.config['STREAM_TEMPLATES'] = False
+
+
+def test_broker():
+    """Deliver published messages to subscribers until they leave."""
+    broker = Broker(maxsize=2)
+    q1 = broker.subscribe()
+    q2 = broker.subscribe()
+    broker.publish('a')
+    assert q1.get_nowait() == 'a'
+    assert q2.get_nowait() == 'a'
+
+    broker.unsubscribe(q2)
+    broker.publish('b')
+    broker.publish('c')
+    broker.publish('d')  # q1 is full, dropped
+    assert q1.get_nowait() == 'b'
+    assert q1.get_nowait() == 'c'
+    assert q1.empty()
+    assert q2.empty()
+
+    # Closing tells even a full subscriber to stop
+    broker.publish('e')
+    broker.publish('f')
+    broker.close()
+    assert q1.get_nowait() == 'f'
+    assert q1.get_nowait() is None
+
+
+@td
+def test_relay(setup):
+    """Publish and count posts written through any process."""
+    u = User(nickname='john', email='john@example.com')
+    db.session.add(u)
+    db.session.commit()
+    db.session.add(Post(body='before', author=u, timestamp=datetime.utcnow()))
+    db.session.commit()
+    relay.key = None
+    relay.poll_once()
+    q = broker.subscribe()
+    try:
+        # Written as if by another worker
+        post = Post(body='#relayed', author=u, timestamp=datetime.utcnow())
+        db.session.add(post)
+        db.session.commit()
+        relay.poll_once()
+        message = q.get_nowait()
+        assert message['post']['body'] == '#relayed'
+        assert message['user_id'] == u.id
+        assert q.empty()
+        assert relay.key == post.id
+        assert '#relayed' in dict(trending.top(50))
+        relay.poll_once()
+        assert q.empty()
+    finally:
+        broker.unsubscribe(q)
+
+    # Closing the broker ends the live update streams
+    q = broker.subscribe()
+    stream = _event_stream(q, {u.id}, [])
+    broker.close()
+    assert list(stream) == []
+
+
+@td
+def test_index_stream_reconnect(setup):
+    """Send a reconnecting client each missed post exactly once."""
+    u = User(nickname='john', email='john@example.com')
+    db.session.add(u)
+    db.session.commit()
+    u.follow(u)
+    db.session.add(u)
+    posts = [Post(body='post {0}'.format(i), author=u,
+                  timestamp=datetime.utcnow()) for i in range(3)]
+    db.session.add_all(posts)
+    db.session.commit()
+    ids = [p.id for p in posts]
+    login(setup, u)
+
+    # The relay hasn't caught up with the posts the client missed
+    relay.key = ids[0]
+    r = setup.get('/index/stream', buffered=False,
+                  headers={'Last-Event-ID': str(ids[0])})
+    db.session.add(Post(body='post 3', author=User.query.one(),
+                        timestamp=datetime.utcnow()))
+    db.session.commit()
+    relay.poll_once()
+    broker.close()
+    body = b''.join(r.response).decode('utf-8')
+    sent = [int(line[4:]) for line in body.splitlines()
+            if line.startswith('id: ')]
+    assert sent == ids[1:] + [relay.key]
+
+
+@td
+def test_index_since(setup):
+    """Return only followed posts newer than the given id."""
+    u1 = User(nickname='john', email='john@example.com')
+    u2 = User(nickname='susan', email='susan@example.com')
+    u3 = User(nickname='mary', email='mary@example.com')
+    db.session.add_all([u1, u2, u3])
+    db.session.commit()
+    u1.follow(u1)
+    u1.follow(u2)
+    db.session.add(u1)
+    utcnow = datetime.utcnow()
+    posts = [Post(body='post {0}'.format(i), author=author,
+                  timestamp=utcnow + timedelta(seconds=i))
+             for i, author in enumerate([u1, u2, u3, u2])]
+    db.session.add_all(posts)
+    db.session.commit()
+
+    assert u1.followed_posts_since(posts[0].id).all() == \
+        [posts[1], posts[3]]
+
+    login(setup, u1)
+    r = setup.get('/index/since/{0}'.format(posts[0].id))
+    assert r.status_code == 200
+    data = json.loads(r.data.decode('utf-8'))
+    assert [p['id'] for p in data['posts']] == [posts[1].id, posts[3].id]
+    assert data['posts'][0]['author'] == 'susan'
+    assert data['last_id'] == posts[3].id
+
+    r = setup.get('/index/since/{0}'.format(posts[3].id))
+    data = json.loads(r.data.decode('utf-8'))
+    assert data == {'posts': [], 'last_id': posts[3].id}
+
+
+@td
+def test_api(setup):
+    """Page through the JSON API with cursors, fields and ETags."""
+    u1 = User(nickname='john', email='john@example.com')
+    u2 = User(nickname='susan', email='susan@example.com')
+    db.session.add_all([u1, u2])
+    db.session.commit()
+    u1.follow(u1)
+    u1.follow(u2)
+    db.session.add(u1)
+    utcnow = datetime.utcnow()
+    posts = [Post(body='post {0}'.format(i), author=[u1, u2][i % 2],
+                  timestamp=utcnow + timedelta(seconds=i))
+             for i in range(5)]
+    db.session.add_all(posts)
+    db.session.commit()
+    ids = [p.id for p in posts]
+
+    login(setup, u1)
+
+    def get_json(url, **kwargs):
+        r = setup.get(url, **kwargs)
+        assert r.status_code == 200
+        return r, json.loads(r.data.decode('utf-8'))
+
+    # Walk the timeline in pages of two
+    seen = []
+    url = '/api/v1/timeline?limit=2&fields=id,author'
+    r, data = get_json(url)
+    while True:
+        assert all(set(p) == {'id', 'author'} for p in data['items'])
+        seen += [p['id'] for p in data['items']]
+        if data['next_cursor'] is None:
+            break
+        r, data = get_json('{0}&cursor={1}'.format(url, data['next_cursor']))
+    assert seen == list(reversed(ids))
+
+    # Revalidate with the ETag
+    r, data = get_json('/api/v1/users/susan')
+    assert data['nickname'] == 'susan'
+    assert data['followers'] == 1
+    assert data['posts'] == 2
+    r = setup.get('/api/v1/users/susan',
+                  headers={'If-None-Match': r.headers['ETag']})
+    assert r.status_code == 304
+
+    # Other requests update last_seen, which doesn't change the ETag
+    r, data = get_json('/api/v1/users/john')
+    etag = r.headers['ETag']
+    setup.get('/api/v1/timeline')
+    r = setup.get('/api/v1/users/john', headers={'If-None-Match': etag})
+    assert r.status_code == 304
+
+    r, data = get_json('/api/v1/users/susan/posts')
+    assert [p['id'] for p in data['items']] == [ids[3], ids[1]]
+    r, data = get_json('/api/v1/users/susan/followers?fields=nickname')
+    assert data['items'] == [{'nickname': 'john'}]
+
+    assert setup.get('/api/v1/users/nobody').status_code == 404
+    assert setup.get('/api/v1/search').status_code == 400
+
+    # Anonymous clients get JSON, not the login page
+    r = app.test_client().get('/api/v1/timeline')
+    assert r.status_code == 401
+    assert r.mimetype == 'application/json'
+    assert json.loads(r.data.decode('utf-8')) == {'error': 'Login required'}
+
+
+@td
+def test_api_search(setup, monkeypatch):
+    """Page through ranked search results with a position cursor."""
+    u = User(nickname='john', email='john@example.com')
+    db.session.add(u)
+    db.session.commit()
+    posts = [Post(body='post {0}'.format(i), author=u,
+                  timestamp=datetime.utcnow()) for i in range(5)]
+    db.session.add_all(posts)
+    db.session.commit()
+    ranked = [posts[i].id for i in (3, 0, 4, 1, 2)]
+
+    def search_posts(query, limit):
+        assert query == 'post'
+        return (Post.query.get(i) for i in ranked[:limit])
+    monkeypatch.setattr(api, 'search_posts', search_posts)
+    monkeypatch.setattr(api, 'MAX_SEARCH_RESULTS', 4)
+    login(setup, u)
+
+    seen = []
+    url = '/api/v1/search?q=post&limit=3&fields=id'
+    while url:
+        data = json.loads(setup.get(url).data.decode('utf-8'))
+        seen += [p['id'] for p in data['items']]
+        url = data['next_cursor'] is not None and \
+            '/api/v1/search?q=post&limit=3&fields=id&cursor={0}'.format(
+                data['next_cursor'])
+    assert seen == ranked[:4]
+
+
+@td
+def test_bulk_roundtrip(setup):
+    """Export every table and import it back unchanged."""
+    u1 = User(nickname='john', email='john@example.com', about_me='hi')
+    u2 = User(nickname='susan', email='susan@example.com', about_me='')
+    db.session.add_all([u1, u2])
+    db.session.commit()
+    u1.follow(u2)
+    db.session.add(u1)
+    db.session.add_all([Post(body='post {0}'.format(i), author=u1,
+                             timestamp=datetime(2017, 1, 1, 12, 0, i))
+                        for i in range(5)])
+    db.session.commit()
+
+    for fmt in bulk.FORMATS:
+        dumps = {}
+        for table in bulk.TABLES:
+            f = io.StringIO()
+            bulk.write_rows(table, bulk.export_rows(table, batch_size=2),
+                            f, fmt)
+            dumps[table] = f.getvalue()
+        before = dict((t, list(bulk.export_rows(t))) for t in bulk.TABLES)
+        assert len(before['post']) == 5
+
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        for table in bulk.TABLES:
+            rows = bulk.read_rows(table, io.StringIO(dumps[table]), fmt)
+            assert bulk.import_rows(table, rows, batch_size=2) == \
+                len(before[table])
+        if fmt == 'csv':
+            # CSV reads empty strings back as NULL
+            before['user'][1]['about_me'] = None
+        else:
+            assert before['user'][1]['about_me'] == ''
+        assert dict((t, list(bulk.export_rows(t)))
+                    for t in bulk.TABLES) == before
+    assert User.query.filter_by(nickname='john').first() \
+        .is_following(User.query.filter_by(nickname='susan').first())
+
+    # Ids that are only in the archive are not handed out again
+    assert archive_posts(timedelta(days=1), now=datetime(2018, 1, 1)) == 5
+    dumps = {}
+    for table in bulk.TABLES:
+        f = io.StringIO()
+        bulk.write_rows(table, bulk.export_rows(table), f, 'ndjson')
+        dumps[table] = f.getvalue()
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+    for table in bulk.TABLES:
+        bulk.import_rows(table, bulk.read_rows(
+            table, io.StringIO(dumps[table]), 'ndjson'))
+    p = Post(body='new', user_id=1, timestamp=datetime(2018, 1, 1))
+    db.session.add(p)
+    db.session.commit()
+    assert p.id > max(a.id for a in ArchivedPost.query)
+
+
+@td
+def test_archive(setup):
+    """Move old posts to the archive and read through to them."""
+    u1 = User(nickname='john', email='john@example.com')
+    db.session.add(u1)
+    db.session.commit()
+    u1.follow(u1)
+    db.session.add(u1)
+    now = datetime(2017, 6, 1)
+    posts = [Post(body='post {0}'.format(i), author=u1,
+                  timestamp=now - timedelta(days=10 - i))
+             for i in range(10)]
+    db.session.add_all(posts)
+    db.session.commit()
+    ids = [p.id for p in posts]
+
+    # The four oldest posts are more than six days old
+    assert archive_posts(timedelta(days=6), batch_size=3, now=now) == 4
+    assert Post.query.count() == 6
+    assert [p.id for p in ArchivedPost.query.order_by(ArchivedPost.id)] == \
+        ids[:4]
+    assert archive_posts(timedelta(days=6), now=now) == 0
+
+    # Offset pagination walks from the hot table into the archive
+    hot = u1.followed_posts()
+    cold = u1.followed_archived_posts()
+    pages = []
+    page = ArchivePagination(hot, cold, 1, 4)
+    while True:
+        pages.append([p.id for p in page.items])
+        if not page.has_next:
+            break
+        page = page.next()
+    assert pages == [ids[9:5:-1], ids[5:1:-1], ids[1::-1]]
+    assert page.total == 10
+    assert page.prev().has_prev and not page.prev().prev().has_prev
+
+    # Cursor pagination does the same
+    seen = []
+    cursor = None
+    while True:
+        rows, cursor = cursor_page(hot, Post.id, cold, ArchivedPost.id,
+                                   cursor, 3)
+        seen += [p.id for p in rows]
+        if cursor is None:
+            break
+    assert seen == list(reversed(ids))
+
+    # Profile pages render posts from both tables
+    login(setup, u1)
+    r = setup.get('/u/john')
+    assert r.status_code == 200
+    assert b'post 9' in r.data and b'post 0' in r.data
+
+
+@td
+def test_archive_never_reuses_ids(setup):
+    """Give new posts ids above every archived post."""
+    u = User(nickname='john', email='john@example.com')
+    db.session.add(u)
+    db.session.commit()
+    login(setup, u)
+    for body in ('hello #flask', 'bye #flask'):
+        setup.post('/index', data={'post': body})
+    Post.query.update({'timestamp': datetime(2017, 1, 1)})
+    db.session.commit()
+    assert archive_posts(timedelta(days=1)) == 2
+    archived = [p.id for p in ArchivedPost.query]
+
+    setup.post('/index', data={'post': 'a new post'})
+    post = Post.query.one()
+    assert post.id > max(archived)
+    assert db.session.query(post_tags).filter_by(post_id=post.id).count() \
+        == 0
+
+
+@td
+def test_post_autoincrement_migration(setup):
+    """Rebuild a post table that reuses ids, in batches."""
+    with db.engine.begin() as conn:
+        conn.execute('DROP TABLE post')
+        conn.execute('CREATE TABLE post (id INTEGER NOT NULL, '
+                     'body VARCHAR(200), timestamp DATETIME, '
+                     'user_id INTEGER, PRIMARY KEY (id))')
+        conn.execute('CREATE INDEX ix_post_timestamp ON post (timestamp)')
+    u = User(nickname='john', email='john@example.com')
+    db.session.add(u)
+    db.session.commit()
+    old = datetime(2017, 1, 1)
+    db.session.add_all([Post(body='post {0}'.format(i), author=u,
+                             timestamp=old + timedelta(days=i))
+                        for i in range(5)])
+    db.session.commit()
+    assert archive_posts(timedelta(days=1), now=old + timedelta(days=4)) \
+        == 3
+    # With the newest posts gone too, archived ids are handed out again
+    Post.query.filter(Post.id > 3).delete()
+    db.session.add(Post(body='reused', author=u, timestamp=old))
+    db.session.commit()
+    assert Post.query.filter_by(body='reused').one().id == 1
+
+    migration = PostAutoincrement()
+    assert run_migration(migration, batch_size=2, report=None,
+                         contract=False) == 'contract'
+    # Writes made during the copy are copied too
+    gone = Post(body='gone', author=u, timestamp=old)
+    db.session.add_all([Post(body='late', author=u, timestamp=old), gone])
+    db.session.commit()
+    db.session.delete(gone)
+    Post.query.filter_by(body='reused').one().body = 'edited'
+    db.session.commit()
+    assert run_migration(migration, report=None) == 'done'
+    db.session.remove()
+
+    assert sorted(p.body for p in Post.query) == ['edited', 'late']
+    with db.engine.connect() as conn:
+        assert has_column_index(conn, 'post', 'timestamp')
+        assert conn.execute("SELECT COUNT(*) FROM sqlite_master "
+                            "WHERE type = 'trigger'").scalar() == 0
+    db.session.add(Post(body='new', author=User.query.one(), timestamp=old))
+    db.session.commit()
+    assert Post.query.filter_by(body='new').one().id > 3
+    assert run_migration(PostAutoincrement()) == 'done'
+
+
+class AboutMeBackfill(OnlineMigration):
+    """Test migration that fills in about_me, optionally failing midway."""
+
+    name = 'about_me_backfill'
+    fail_after = None
+
+    def __init__(self):
+        """Keep track of the batches seen."""
+        self.batches = []
+
+    def total(self, conn):
+        """Count the users to backfill."""
+        return conn.execute('SELECT count(*) FROM user').scalar()
+
+    def backfill(self, conn, after, batch_size):
+        """Set about_me on the next batch of users."""
+        if self.fail_after is not None and \
+                len(self.batches) == self.fail_after:
+            raise RuntimeError('interrupted')
+        ids = [r[0] for r in conn.execute(
+            'SELECT id FROM user WHERE id > ? ORDER BY id LIMIT ?',
+            (after or 0, batch_size))]
+        if not ids:
+            return after, 0
+        conn.execute("UPDATE user SET about_me = 'migrated' "
+                     "WHERE id >= ? AND id <= ?", (ids[0], ids[-1]))
+        self.batches.append(ids)
+        return ids[-1], len(ids)
+
+
+@td
+def test_online_migration(setup):
+    """Run a backfill in batches and resume it after a failure."""
+    db.session.add_all([User(nickname='user{0}'.format(i),
+                             email='user{0}@example.com'.format(i))
+                        for i in range(10)])
+    db.session.commit()
+
+    migration = AboutMeBackfill()
+    migration.fail_after = 2
+    with pytest.raises(RuntimeError):
+        run_migration(migration, batch_size=3, report=None)
+    assert User.query.filter_by(about_me='migrated').count() == 6
+
+    reports = []
+    migration = AboutMeBackfill()
+    assert run_migration(migration, batch_size=3,
+                         report=reports.append) == 'done'
+    # Picked up after the last committed batch
+    assert migration.batches[0][0] == 7
+    assert User.query.filter_by(about_me='migrated').count() == 10
+    assert reports[-1].rows_done == reports[-1].total == 10
+    assert '10/10 (100.0%)' in str(reports[-1])
+
+    # Finished migrations are not run again
+    migration = AboutMeBackfill()
+    assert run_migration(migration) == 'done'
+    assert migration.batches == []
+
+    # A database created before post.timestamp was indexed gets the index
+    with db.engine.begin() as conn:
+        conn.execute('DROP INDEX ix_post_timestamp')
+        assert not has_index(conn, 'post', 'ix_post_timestamp')
+    assert run_migration(PostTimestampIndex()) == 'done'
+    with db.engine.connect() as conn:
+        assert has_index(conn, 'post', 'ix_post_timestamp')
+        plan = conn.execute('EXPLAIN QUERY PLAN SELECT id FROM post '
+                            'ORDER BY timestamp DESC').fetchall()
+    assert 'ix_post_timestamp' in ' '.join(str(row) for row in plan)
+
+
+def test_parse_terms():
+    """Find hashtags and mentions in a post body."""
+    tags, nicknames = parse_terms('#Flask is fun, says @john. cc @mary_1 '
+                                  'email@example.com issue#3 #flask')
+    assert tags == {'flask'}
+    assert nicknames == {'john', 'mary_1'}
+    assert parse_terms('nothing here') == (set(), set())
+
+
+@td
+def test_tags_and_mentions(setup):
+    """Index new posts and look them up by tag and mention."""
+    u1 = User(nickname='john', email='john@example.com')
+    u2 = User(nickname='susan', email='susan@example.com')
+    db.session.add_all([u1, u2])
+    db.session.commit()
+    login(setup, u1)
+
+    r = setup.post('/index', data={'post': 'hello @susan #Flask'})
+    assert r.status_code == 302
+    post = Post.query.one()
+    assert db.session.query(post_tags).filter_by(post_id=post.id).count() \
+        == 1
+    assert Tag.query.one().name == 'flask'
+
+    r = setup.get('/tag/flask')
+    assert r.status_code == 200 and b'hello @susan' in r.data
+    assert b'hello @susan' not in setup.get('/tag/python').data
+
+    # Tags too long to store are cut the same way when looked up
+    long_tag = 'Long' * 20
+    setup.post('/index', data={'post': 'so #{0}'.format(long_tag)})
+    assert Tag.query.filter_by(name=long_tag.lower()[:64]).count() == 1
+    assert b'so #' in setup.get('/tag/{0}'.format(long_tag)).data
+    assert '#' + long_tag.lower()[:64] in extract_terms('#' + long_tag)
+
+    login(setup, User.query.filter_by(nickname='susan').one())
+    assert b'hello @susan' in setup.get('/mentions').data
+
+
+@td
+def test_terms_backfill(setup):
+    """Index posts written before hashtags were parsed."""
+    u1 = User(nickname='john', email='john@example.com')
+    db.session.add(u1)
+    db.session.commit()
+    db.session.add_all([Post(body='#tag{0} @john'.format(i % 3), author=u1,
+                             timestamp=datetime.utcnow())
+                        for i in range(7)])
+    db.session.commit()
+
+    assert run_migration(PostTermsBackfill(), batch_size=3,
+                         report=None) == 'done'
+    assert Tag.query.count() == 3
+    assert db.session.query(post_tags).count() == 7
+    assert db.session.query(mentions).filter_by(user_id=u1.id).count() == 7
+
+
+def test_two_hop_recommendations():
+    """Recommend the users followed by the users you follow."""
+    # 1 follows 2 and 3, who both follow 4; 3 also follows 5
+    edges = [(1, 1), (2, 2), (3, 3), (4, 4), (5, 5),
+             (1, 2), (1, 3), (2, 4), (3, 4), (3, 5), (2, 1)]
+    follower_ids, followed_ids = zip(*edges)
+    for block_size in (1, 2, 100):
+        users, recommended, scores = two_hop_recommendations(
+            follower_ids, followed_ids, top_n=2, block_size=block_size)
+        got = sorted(zip(users.tolist(), recommended.tolist(),
+                         scores.tolist()))
+        assert got == [(1, 4, 2), (1, 5, 1), (2, 3, 1)]
+
+    # Only the best top_n are kept
+    users, recommended, scores = two_hop_recommendations(
+        follower_ids, followed_ids, top_n=1)
+    assert sorted(zip(users.tolist(), recommended.tolist())) == \
+        [(1, 4), (2, 3)]
+    assert len(two_hop_recommendations([], [])[0]) == 0
+
+
+@td
+def test_compute_recommendations(setup):
+    """Store recommendations and show the ones not followed yet."""
+    users = [User(nickname=n, email='{0}@example.com'.format(n))
+             for n in ('john', 'susan', 'mary', 'david')]
+    db.session.add_all(users)
+    db.session.commit()
+    john, susan, mary, david = users
+    for u in users:
+        u.follow(u)
+    john.follow(susan)
+    susan.follow(mary)
+    susan.follow(david)
+    mary.follow(david)
+    db.session.add_all(users)
+    db.session.commit()
+
+    assert compute_recommendations(top_n=10) > 0
+    # Equal scores, so the lower id comes first
+    assert john.recommended_users(5).all() == [mary, david]
+
+    # Following a recommendation hides it until the next run
+    john.follow(mary)
+    db.session.add(john)
+    db.session.commit()
+    assert john.recommended_users(5).all() == [david]
+
+    login(setup, john)
+    r = setup.get('/u/john')
+    assert b'Who to follow' in r.data and b'david' in r.data
+
+
+def test_count_min_sketch():
+    """Never underestimate counts."""
+    sketch = CountMinSketch(width=64, depth=3)
+    for i in range(500):
+        sketch.add('term{0}'.format(i % 50))
+    sketch.add('hot', 100)
+    assert sketch.estimate('hot') >= 100
+    assert all(sketch.estimate('term{0}'.format(i)) >= 10
+               for i in range(50))
+    sketch.scale(0.5)
+    assert sketch.estimate('hot') >= 50
+
+
+def test_trending_terms():
+    """Track the most frequent recent terms."""
+    assert extract_terms('The #Flask app and the flask app, 2017') == \
+        {'#flask', 'app', 'flask'}
+
+    trending = TrendingTerms(k=3, half_life=60)
+    now = trending._epoch
+    for i in range(10):
+        trending.observe('python rocks', now=now)
+    for i in range(5):
+        trending.observe('#flask', now=now)
+    for i in range(20):
+        trending.observe('word{0}'.format(i), now=now)
+    top = trending.top(2, now=now)
+    assert [term for term, score in top] == ['python', 'rocks']
+    assert top[0][1] >= 10
+    # Reads between posts reuse the ranking
+    ranked = trending._ranked
+    trending.top(3, now=now + 30)
+    assert trending._ranked is ranked
+
+    # One half-life later the same counts are worth half
+    assert trending.top(1, now=now + 60)[0][1] == top[0][1] / 2
+
+    # A burst of a new term pushes out old ones
+    later = now + 600
+    for i in range(5):
+        trending.observe('#release', now=later)
+    assert trending.top(1, now=later)[0][0] == '#release'
+
+
+@td
+def test_trending_snapshot(setup):
+    """Restore trending terms from the last snapshot."""
+    trending = TrendingTerms(k=5, half_life=60, snapshot_interval=30)
+    now = trending._epoch
+    for i in range(4):
+        trending.observe('#flask python', now=now)
+    assert not trending.maybe_snapshot(now=now + 10)
+    assert trending.maybe_snapshot(now=now + 30)
+
+    restored = TrendingTerms(k=5, half_life=60)
+    restored.restore(now=now + 90)
+    top = dict(restored.top(now=now + 90))
+    assert set(top) == {'#flask', 'python'}
+    # Decayed over the 90 seconds since the posts
+    assert abs(top['python'] - 4 / 2.0 ** 1.5) < 1e-6
+
+
+@td
+def test_warm(setup):
+    """Warm every part of the app before serving."""
+    timings = warm(app)
+    assert set(timings) == {'templates', 'translations', 'search',
+                            'database'}
+    # Templates are compiled and cached
+    assert app.jinja_env.get_template('index.html') is \
+        app.jinja_env.get_template('index.html')
+
+
+def _children(pid):
+    """Return the pids of the live child processes of a process."""
+    pids = set()
+    for name in os.listdir('/proc'):
+        try:
+            with open('/proc/{0}/stat'.format(name)) as f:
+                stat = f.read().rsplit(')', 1)[1].split()
+        except (IOError, ValueError, IndexError):
+            continue
+        if stat[0] != 'Z' and int(stat[1]) == pid:
+            pids.add(int(name))
+    return pids
+
+
+def _wait_for(check, timeout=10):
+    """Wait until check() returns something true, and return it."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        result = check()
+        if result:
+            return result
+        time.sleep(0.1)
+    raise AssertionError('timed out')
+
+
+@td
+def test_prefork_server(setup):
+    """Serve from forked workers, reload them on SIGHUP and stop."""
+    server = PreforkServer(app, port=0, workers=2, stop_timeout=5)
+    url = 'http://127.0.0.1:{0}/login'.format(server.port)
+    master = os.fork()
+    if master == 0:
+        status = 1
+        try:
+            server.run()
+            status = 0
+        finally:
+            os._exit(status)
+    server.sock.close()
+
+    def new_workers(old=()):
+        """Return the workers once there are two, none of them in old."""
+        pids = _children(master)
+        if len(pids) == 2 and not pids & set(old):
+            return pids
+
+    try:
+        workers = _wait_for(new_workers)
+        assert urlopen(url, timeout=5).getcode() == 200
+
+        # An idle connection, like a live update stream, doesn't keep the
+        # worker from serving others
+        idle = [socket.create_connection(('127.0.0.1', server.port))
+                for i in range(4)]
+        assert urlopen(url, timeout=5).getcode() == 200
+        for conn in idle:
+            conn.close()
+
+        os.kill(master, signal.SIGHUP)
+        reloaded = _wait_for(lambda: new_workers(workers))
+        assert urlopen(url, timeout=5).getcode() == 200
+
+        # A worker that dies is replaced
+        os.kill(min(reloaded), signal.SIGKILL)
+        _wait_for(lambda: new_workers([min(reloaded)]))
+        assert urlopen(url, timeout=5).getcode() == 200
+
+        os.kill(master, signal.SIGTERM)
+        _wait_for(lambda: not _children(master))
+        assert os.waitpid(master, 0) == (master, 0)
+        master = None
+        with pytest.raises(IOError):
+            urlopen(url, timeout=5)
+    finally:
+        if master is not None:
+            for pid in _children(master) | {master}:
+                os.kill(pid, signal.SIGKILL)
+            os.waitpid(master, 0)
+
+
+@td
+def test_openid_store(setup):
+    """Keep OpenID associations and nonces in the database."""
+    store = SQLAlchemyStore(cleanup_interval=60)
+    server = 'http://op.example.com/openid'
+    old = Association.fromExpiresIn(600, 'old', b'\x00' * 20, 'HMAC-SHA1')
+    old.issued -= 10
+    new = Association.fromExpiresIn(600, 'new', b'\xff' * 20, 'HMAC-SHA1')
+    expired = Association('expired', b'secret', 0, 600, 'HMAC-SHA1')
+    for assoc in (old, new, expired):
+        store.storeAssociation(server, assoc)
+    assert store.getAssociation(server) == new
+    assert store.getAssociation(server, 'old') == old
+    assert store.getAssociation(server, 'expired') is None
+    assert store.getAssociation('http://other.example.com') is None
+    assert store.removeAssociation(server, 'new')
+    assert not store.removeAssociation(server, 'new')
+    assert store.getAssociation(server) == old
+
+    start = store._last_cleanup
+    now = int(start)
+    assert store.useNonce(server, now, 'salt')
+    assert not store.useNonce(server, now, 'salt')
+    assert store.useNonce(server, now, 'pepper')
+    assert not store.useNonce(server, now - nonce.SKEW - 10, 'stale')
+
+    # Expired rows are deleted once the cleanup interval has passed
+    with db.engine.begin() as conn:
+        conn.execute(oid_nonces.insert(), {'server_url': server, 'salt': 'x',
+                                           'timestamp': now - nonce.SKEW - 1})
+    assert not store.maybe_cleanup(start + 30)
+    assert store.maybe_cleanup(start + 60)
+    with db.engine.connect() as conn:
+        assert sorted(row.salt for row in
+                      conn.execute(oid_nonces.select())) == ['pepper', 'salt']
+        assert sorted(row.handle for row in
+                      conn.execute(oid_associations.select())) == ['old']
+
+
+def test_discovery_cache():
+    """Cache discovery of the OpenID provider URLs."""
+    calls = []
+
+    def discover(url):
+        calls.append(url)
+        if 'down' in url:
+            return url, []
+        return url, [OpenIDServiceEndpoint.fromOPEndpointURL(url + '/op')]
+
+    providers = [{'name': 'Google', 'url': 'https://op.example.com/id'},
+                 {'name': 'AOL', 'url': 'http://aol.example.com/<username>'},
+                 {'name': 'Down', 'url': 'http://down.example.com'}]
+    cache = DiscoveryCache(providers, ttl=60, discover=discover)
+    assert cache.cacheable('https://op.example.com/id')
+    assert cache.cacheable('http://aol.example.com/john/')
+    assert not cache.cacheable('http://aol.example.com/john/posts')
+    assert not cache.cacheable('https://op.example.com/id/x')
+
+    claimed_id, services = cache.discover('https://op.example.com/id')
+    services.pop()
+    claimed_id, services = cache.discover('https://op.example.com/id')
+    assert len(services) == 1
+    assert services[0].server_url == 'https://op.example.com/id/op'
+    cache.discover('http://aol.example.com/john')
+    cache.discover('http://aol.example.com/john')
+    cache.discover('http://aol.example.com/susan')
+    cache.discover('http://someone.example.com')
+    cache.discover('http://someone.example.com')
+    cache.discover('http://down.example.com')
+    cache.discover('http://down.example.com')
+    assert calls == ['https://op.example.com/id',
+                     'http://aol.example.com/john',
+                     'http://aol.example.com/susan',
+                     'http://someone.example.com',
+                     'http://someone.example.com',
+                     'http://down.example.com',
+                     'http://down.example.com']
+
+    # Entries expire after the ttl, and are dropped when next asked for
+    cache.ttl = 0
+    cache.clear()
+    cache.discover('https://op.example.com/id')
+    cache.discover('http://aol.example.com/john')
+    assert len(cache) == 2
+    cache.discover('https://op.example.com/id')
+    assert calls[-3:] == ['https://op.example.com/id',
+                          'http://aol.example.com/john',
+                          'https://op.example.com/id']
+    cache.ttl = 60
+    cache.clear()
+
+    # Only the most recently used results are kept
+    cache.max_size = 2
+    for name in ('a', 'b', 'a', 'c'):
+        cache.discover('http://aol.example.com/{0}'.format(name))
+    assert len(cache) == 2
+    del calls[:]
+    cache.discover('http://aol.example.com/a')
+    cache.discover('http://aol.example.com/c')
+    assert calls == []
+    cache.discover('http://aol.example.com/b')
+    assert calls == ['http://aol.example.com/b']
+
+
+@td
+def test_openid_login(setup):
+    """Log in through a stub provider, discovering it only once."""
+    calls = []
+
+    def discover(url):
+        calls.append(url)
+        return url, [OpenIDServiceEndpoint.fromOPEndpointURL(
+            'http://localhost/stub-op')]
+
+    provider = 'https://stub.example.com/id'
+    cache = DiscoveryCache([{'name': 'Stub', 'url': provider}],
+                           discover=discover)
+    discovers = (consumer.Consumer.__dict__['_discover'],
+                 consumer.GenericConsumer.__dict__['_discover'])
+    cache.install()
+    # An existing association means the provider is never contacted
+    openid_store.storeAssociation('http://localhost/stub-op',
+                                  Association.fromExpiresIn(
+                                      600, 'stub', b'\x00' * 20,
+                                      'HMAC-SHA1'))
+    try:
+        for i in range(2):
+            rv = setup.post('/login', data={'openid': provider})
+            assert rv.status_code == 302
+            assert rv.location.startswith('http://localhost/stub-op?')
+            assert 'openid.mode=checkid_setup' in rv.location
+            assert 'openid.assoc_handle=stub' in rv.location
+    finally:
+        consumer.Consumer._discover, consumer.GenericConsumer._discover = \
+            discovers
+    assert calls == [provider]